@@ -1,11 +1,55 @@
+type Request = { id: number; type: "play"; urls: string[] };
+
+async function albumTracks(uri: string): Promise<string[]> {
+  const response = await Spicetify.GraphQL.Request(
+    Spicetify.GraphQL.Definitions.getAlbum,
+    { uri, locale: Spicetify.Locale.getLocale(), offset: 0, limit: 500 },
+  );
+  const album = response.data.albumUnion;
+  const items: any[] = (album.tracksV2 ?? album.tracks).items;
+  return items.map((item) => item.track.uri);
+}
+
+async function playlistTracks(uri: string): Promise<string[]> {
+  const contents = await Spicetify.Platform.PlaylistAPI.getContents(uri);
+  return contents.items.map((item: { uri: string }) => item.uri);
+}
+
+async function expand(url: string): Promise<string[]> {
+  const uri = Spicetify.URI.from(url);
+  if (!uri) {
+    throw new Error(`${url} is not a Spotify URL.`);
+  }
+  if (Spicetify.URI.isAlbum(uri)) {
+    return albumTracks(uri.toURI());
+  }
+  if (Spicetify.URI.isPlaylistV1OrV2(uri)) {
+    return playlistTracks(uri.toURI());
+  }
+  return [uri.toURI()];
+}
+
+async function handle(request: Request): Promise<number> {
+  if (request.type !== "play") {
+    throw new Error(`Unknown request type ${request.type}.`);
+  }
+  const tracks = (await Promise.all(request.urls.map(expand))).flat();
+  await Spicetify.addToQueue(tracks.map((uri) => ({ uri })));
+  return tracks.length;
+}
+
 function createSocket() {
   const websocket = new WebSocket("ws://localhost:8765/");
   websocket.onopen = () =>
     console.log("Doorbell Integration: Connected to Doorbell.");
-  websocket.onmessage = (event) => {
-    const uri = Spicetify.URI.from(event.data);
-    if (uri) {
-      Spicetify.addToQueue([{ uri: uri.toURI() }]);
+  websocket.onmessage = async (event) => {
+    const request: Request = JSON.parse(event.data);
+    try {
+      const queued = await handle(request);
+      websocket.send(JSON.stringify({ id: request.id, ok: true, queued }));
+    } catch (error) {
+      const message = error instanceof Error ? error.message : String(error);
+      websocket.send(JSON.stringify({ id: request.id, ok: false, error: message }));
     }
   };
   websocket.onclose = () => {
@@ -0,0 +1,128 @@
+"""Contains AsyncDoorbell which runs Doorbell on a single asyncio event loop."""
+
+import asyncio
+import functools
+import logging
+from typing import Any, Awaitable, Callable, Optional
+
+from slack_bolt.adapter.socket_mode.async_handler import AsyncSocketModeHandler
+from slack_bolt.async_app import AsyncApp
+from slack_sdk.web.async_client import AsyncSlackResponse, AsyncWebClient
+
+import database
+import metrics
+from audio import AudioPlayer
+from doorbell import Doorbell
+from secret import APP_TOKEN
+
+logger = logging.getLogger(__name__)
+
+
+class _TimedAsyncWebClient(AsyncWebClient):
+    """The async version of metrics.TimedWebClient."""
+
+    async def api_call(self, api_method: str, *args: Any, **kwargs: Any) -> AsyncSlackResponse:  # type: ignore
+        with metrics.timed("slack_api", method=api_method):
+            return await super().api_call(api_method, *args, **kwargs)
+
+
+class _BridgedApp:
+    """Stands in for App when registering Doorbell's listeners so that they get registered on an AsyncApp.
+    Every listener is wrapped by bridge() before being handed to the AsyncApp."""
+
+    def __init__(self, app: AsyncApp, bridge: Callable[[Callable[..., None]], Callable[..., Awaitable[None]]]) -> None:
+        self.app = app
+        self.bridge = bridge
+
+    def __getattr__(self, name: str) -> Callable[..., Callable[[Callable[..., None]], None]]:
+        register = getattr(self.app, name)  # event(), command(), action(), view_submission(), etc.
+
+        def listener_decorator(*args: Any, **kwargs: Any) -> Callable[[Callable[..., None]], None]:
+            decorator = register(*args, **kwargs)
+            return lambda listener: decorator(self.bridge(listener))
+
+        return listener_decorator
+
+
+class AsyncDoorbell(Doorbell):
+    """Doorbell running on one asyncio event loop with slack_bolt's AsyncApp, with the Spotify hub
+    and the event poller running as tasks. The blocking listeners shared with Doorbell are run in worker threads
+    through asyncio.to_thread() so they never stall the loop. Start it with run()."""
+
+    def _start(self) -> None:
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stop: Optional[asyncio.Event] = None
+        self._handler: Optional[AsyncSocketModeHandler] = None
+
+    def run(self) -> None:
+        """Connects to Slack and runs everything on a new event loop until Doorbell is closed."""
+        asyncio.run(self._run())
+
+    async def _run(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        handler = AsyncSocketModeHandler(self._create_app(), APP_TOKEN)
+        self._handler = handler
+        tasks = [
+            asyncio.create_task(asyncio.to_thread(self.directory.warm)),
+            asyncio.create_task(self._poll_events()),
+            asyncio.create_task(self.spotify.serve()),
+        ]
+        metrics_server = metrics.start_server()
+        self.backups.start()
+        try:
+            await handler.connect_async()
+            await self._stop.wait()
+        finally:
+            self.closed = True
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await handler.close_async()
+            self.backups.stop()
+            self._command_pool.shutdown(wait=False, cancel_futures=True)
+            metrics_server.shutdown()
+            metrics_server.server_close()
+            self._audio_player.when_ready(AudioPlayer.stop)
+            self.outbox.close()
+            database.close()
+            self._closed_event.set()
+
+    def _create_app(self) -> AsyncApp:  # type: ignore[override]
+        app = AsyncApp(client=_TimedAsyncWebClient(token=self.client.token, base_url=self.client.base_url))
+        self.register_listeners(_BridgedApp(app, self._bridge))  # type: ignore
+        return app
+
+    def _swap_app(self, app: AsyncApp) -> None:  # type: ignore[override]
+        if self._handler is not None:
+            self._handler.app = app
+
+    async def _poll_events(self) -> None:
+        await self._calendar.wait_async()  # The poller can't do anything without it
+        await self.event_poller.run_async()
+
+    def close(self) -> None:
+        """Stops the event loop, which disconnects from Slack and cancels all of Doorbell's tasks.
+        Safe to call from any thread."""
+        if self.closed or self._loop is None or self._stop is None:
+            return
+        self._loop.call_soon_threadsafe(self._stop.set)
+
+    def _bridge(self, listener: Callable[..., None]) -> Callable[..., Awaitable[None]]:
+        """Wraps a blocking listener so that AsyncApp can run it in a worker thread. The async
+        utilities Bolt passes in are swapped for blocking versions that run on the event loop."""
+
+        @functools.wraps(listener)  # Bolt looks at the wrapped listener's arguments to decide what to pass in
+        async def async_listener(**kwargs: Any) -> None:
+            loop = asyncio.get_running_loop()
+            for name in ("ack", "say", "respond"):
+                if name in kwargs:
+                    kwargs[name] = self._blocking(kwargs[name], loop)
+            if "client" in kwargs:
+                kwargs["client"] = self.client
+            await asyncio.to_thread(listener, **kwargs)
+
+        return async_listener
+
+    def _blocking(self, function: Callable[..., Awaitable[Any]], loop: asyncio.AbstractEventLoop) -> Callable[..., Any]:
+        return lambda *args, **kwargs: asyncio.run_coroutine_threadsafe(function(*args, **kwargs), loop).result()
@@ -0,0 +1,139 @@
+"""Contains the AudioPlayer which plays doorbell announcements in the background."""
+
+import logging
+from collections import OrderedDict
+from queue import Empty, Queue
+from threading import Thread
+from time import monotonic, sleep
+from typing import Any, Final, Optional
+
+from pygame import mixer
+
+import metrics
+from tts import TTS
+
+logger = logging.getLogger(__name__)
+
+
+class AudioPlayer(Thread):
+    """Plays doorbell announcements, the chime followed by text to speech, from a queue so that whoever
+    queues them never has to wait. The first ring's announcement is synthesized while the chime plays.
+    Rings that come in before it ends are merged into a single announcement, e.g. "Alice, Bob and Carol are
+    at the door 12a", and once a second ring has come in the others have until coalesce_seconds after the first.
+    A user ringing the same door again within repeat_seconds is ignored. The most recently used
+    announcements are kept already synthesized because the same people tend to ring every day."""
+
+    MAX_NAMES: Final = 4  # Any more people are announced as "and 3 others" to keep announcements short
+
+    def __init__(
+        self,
+        chime: mixer.Sound,
+        text_to_speech: TTS,
+        cache_size: int = 32,
+        coalesce_seconds: float = 2.0,
+        repeat_seconds: float = 30.0,
+    ) -> None:
+        super().__init__(target=self._play_queued, name="Audio Player")
+        self.chime = chime
+        self.text_to_speech = text_to_speech
+        self.cache_size = cache_size
+        self.coalesce_seconds = coalesce_seconds
+        self.repeat_seconds = repeat_seconds
+        self._queue: Queue[Optional[tuple[str, str]]] = Queue()
+        self._cache: OrderedDict[str, Any] = OrderedDict()  # Text: Synthesized Speech
+        self._announced: dict[tuple[str, str], float] = {}  # (User, Door): When they were last announced
+        self._stopping = False
+
+    def announce(self, user: str, door: str) -> None:
+        """Queues the chime and an announcement that a user is at a door."""
+        self._queue.put((user, door))
+
+    def stop(self) -> None:
+        """Stops this thread after the queued announcements have played."""
+        self._queue.put(None)
+
+    def _play_queued(self) -> None:
+        while not self._stopping:
+            job = self._queue.get()
+            if job is None:
+                break
+            if self._is_repeat(*job, monotonic()):  # Don't even chime for someone who was just announced
+                continue
+            try:
+                self._play(job)
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.exception("Couldn't announce %s at the door %s.", *job)  # The next ring might work
+        logger.info("Stopped Audio Player.")
+
+    @metrics.timed("announcement")
+    def _play(self, first: tuple[str, str]) -> None:
+        """Plays the chime while synthesizing the first ring's announcement and collecting any other rings,
+        then announces all of them at once."""
+        self.chime.play()
+        start = monotonic()
+        chime_end = start + self.chime.get_length()
+        rings = [first]
+        text = self._announcement(rings, start)
+        speech = self._speech(text)
+        self._collect(rings, chime_end, start + self.coalesce_seconds)
+        now = monotonic()
+        if len(rings) > 1 and (merged := self._announcement(rings, now)) != text:
+            text, speech = merged, self._speech(merged)  # Only merging costs another synthesis
+        self._remember(rings, now)
+        sleep(max(chime_end - monotonic(), 0))
+        self.text_to_speech.play(speech, blocking=True)
+
+    def _collect(self, rings: list[tuple[str, str]], chime_end: float, coalesce_end: float) -> None:
+        """Adds the rings that are queued before the chime ends, or before coalesce_end once there's more than one."""
+        until = chime_end
+        while True:
+            try:
+                job = self._queue.get(timeout=max(until - monotonic(), 0))  # Rings queued during synthesis count
+            except Empty:
+                return
+            if job is None:
+                self._stopping = True
+                return
+            rings.append(job)
+            until = max(until, coalesce_end)
+
+    def _announcement(self, rings: list[tuple[str, str]], now: float) -> str:
+        doors: dict[str, list[str]] = {}  # Door: Users, in the order they rang
+        for user, door in rings:
+            if not self._is_repeat(user, door, now) and user not in doors.get(door, []):
+                doors.setdefault(door, []).append(user)
+        sentences = []
+        for door, users in doors.items():
+            verb = "is" if len(users) == 1 else "are"
+            sentences.append(f"{self._names(users)} {verb} at the door {door}".strip())
+        return ". ".join(sentences)
+
+    def _remember(self, rings: list[tuple[str, str]], now: float) -> None:
+        """Records that the rings were announced, so repeats of them within repeat_seconds are ignored."""
+        for user, door in rings:
+            if not self._is_repeat(user, door, now):
+                self._announced[(user, door)] = now
+        self._announced = {key: at for key, at in self._announced.items() if now - at < self.repeat_seconds}
+
+    def _is_repeat(self, user: str, door: str, now: float) -> bool:
+        last = self._announced.get((user, door))
+        return last is not None and now - last < self.repeat_seconds
+
+    def _names(self, users: list[str]) -> str:
+        if len(users) > self.MAX_NAMES:
+            users = [*users[: self.MAX_NAMES - 1], f"{len(users) - self.MAX_NAMES + 1} others"]
+        if len(users) == 1:
+            return users[0]
+        return f"{', '.join(users[:-1])} and {users[-1]}"
+
+    def _speech(self, text: str) -> Any:
+        speech = self._cache.get(text)
+        if speech is not None:
+            self._cache.move_to_end(text)
+            return speech
+        with metrics.timed("tts_synthesize"):
+            speech = self.text_to_speech.synthesize(text)
+        self._cache[text] = speech
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return speech
@@ -0,0 +1,218 @@
+"""Contains Doorbell's database backups. Snapshots are copied out of the live database a few pages at a time
+with SQLite's online backup API, so nothing else has to wait for them, and are kept gzipped under BACKUP_DIR.
+Every FULL_EVERY-th scheduled snapshot is a full copy, the ones in between are incremental: a gzipped SQL
+script of the rows that changed since the previous snapshot. restore() rebuilds a database from them.
+Snapshots are written under a temporary name and renamed once they're complete, so a crash never leaves a partial one.
+The next incremental snapshot is diffed against an uncompressed copy of the newest one, named after it, so that
+renaming a snapshot into place also switches what the next one diffs against.
+After each one the database's journal is told it can drop the changes the snapshot has."""
+
+import gzip
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+from datetime import datetime
+from pathlib import Path
+from threading import Event, Thread
+from typing import Final, Iterator, Optional
+
+import database
+import metrics
+
+logger = logging.getLogger(__name__)
+BACKUP_DIR: Final = "./backups/"
+INTERVAL_SECONDS: Final = 6 * 60 * 60
+KEEP: Final = 28  # A week of snapshots
+FULL_EVERY: Final = 4
+PAGES_PER_STEP: Final = 64  # Pages copied at a time, the database is only locked while each step runs
+CHUNK_SIZE: Final = 1024 * 1024
+FULL_SUFFIX: Final = ".db.gz"
+INCREMENTAL_SUFFIX: Final = ".sql.gz"
+BASE_SUFFIX: Final = ".db"  # Uncompressed copy of a snapshot to diff the next one against
+
+
+def snapshot(destination: str) -> None:
+    """Copies a consistent snapshot of the database to destination, including changes that haven't been flushed."""
+    database.flush()
+    with metrics.timed("backup", step="snapshot"):
+        source = sqlite3.connect(database.FILE_PATH)
+        target = sqlite3.connect(destination)
+        try:
+            source.backup(target, pages=PAGES_PER_STEP)
+        finally:
+            target.close()
+            source.close()
+
+
+def compressed_snapshot() -> str:
+    """Takes a snapshot and gzips it into a temporary file, returns its path. The caller should delete it."""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "snapshot.db")
+        snapshot(path)
+        handle, compressed = tempfile.mkstemp(suffix=FULL_SUFFIX)
+        os.close(handle)
+        _compress(path, compressed)
+    return compressed
+
+
+def take() -> str:
+    """Takes a scheduled snapshot, full or incremental, into BACKUP_DIR and removes the oldest ones past KEEP.
+    Returns the path of the new snapshot."""
+    Path(BACKUP_DIR).mkdir(exist_ok=True)
+    snapshots = _snapshots()
+    previous = _base_path(snapshots[-1]) if snapshots else ""  # What the newest snapshot was taken from
+    name = BACKUP_DIR + datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    current = name + BASE_SUFFIX  # Only used once the snapshot named after it is in place
+    snapshot(current)
+    full = (
+        not os.path.exists(previous)
+        or _since_full() >= FULL_EVERY - 1
+        or database.schema_version(previous) != database.schema_version(current)  # Diffs can't change tables
+    )
+    path = name + (FULL_SUFFIX if full else INCREMENTAL_SUFFIX)
+    if full:
+        _compress(current, path + ".tmp")
+    else:
+        with metrics.timed("backup", step="diff"), gzip.open(path + ".tmp", "wt", encoding="utf-8") as script:
+            for statement in _diff(previous, current):
+                script.write(statement + "\n")
+    database.replace_atomically(path + ".tmp", path)
+    database.backed_up(database.journal_position(current))
+    _remove_leftovers(keep=current)
+    _rotate()
+    logger.info("Backed up the database to %s.", path)
+    return path
+
+
+def restore(destination: str, until: Optional[str] = None) -> None:
+    """Rebuilds the database as of the snapshot named until (defaults to the newest) into destination,
+    starting from the full snapshot before it and applying every incremental one after that."""
+    snapshots = _snapshots()
+    if until is not None:
+        snapshots = snapshots[: [path.name for path in snapshots].index(Path(until).name) + 1]
+    fulls = [i for i, path in enumerate(snapshots) if path.name.endswith(FULL_SUFFIX)]
+    if not fulls:
+        raise FileNotFoundError(f"No full snapshot in {BACKUP_DIR}.")
+    with gzip.open(snapshots[fulls[-1]], "rb") as source, open(destination, "wb") as target:
+        shutil.copyfileobj(source, target, CHUNK_SIZE)
+    conn = sqlite3.connect(destination)
+    try:
+        for path in snapshots[fulls[-1] + 1 :]:
+            with gzip.open(path, "rt", encoding="utf-8") as script:
+                conn.executescript(f"BEGIN;\n{script.read()}COMMIT;")
+    finally:
+        conn.close()
+
+
+class Scheduler(Thread):
+    """Takes a snapshot every INTERVAL_SECONDS, and one right away if there isn't one yet."""
+
+    def __init__(self, interval_seconds: float = INTERVAL_SECONDS) -> None:
+        super().__init__(target=self._continuously_back_up, name="Backups", daemon=True)
+        self.interval_seconds = interval_seconds
+        self._stopped = Event()
+
+    def stop(self) -> None:
+        """Stops this thread."""
+        self._stopped.set()
+
+    def _continuously_back_up(self) -> None:
+        if database.backup_position() is None:  # The journal keeps growing until there's a backup
+            self._take()
+        while not self._stopped.wait(self.interval_seconds):
+            self._take()
+
+    def _take(self) -> None:
+        try:
+            take()
+        except (OSError, sqlite3.Error):
+            logger.exception("Couldn't back up the database.")
+
+
+def _compress(source: str, destination: str) -> None:
+    with metrics.timed("backup", step="compress"):
+        with open(source, "rb") as raw, gzip.open(destination, "wb") as compressed:
+            shutil.copyfileobj(raw, compressed, CHUNK_SIZE)
+
+
+def _diff(previous: str, current: str) -> Iterator[str]:
+    """Yields the SQL statements that turn the previous snapshot into the current one, row by row."""
+    conn = sqlite3.connect(current)
+    try:
+        conn.execute("ATTACH DATABASE ? AS previous", (previous,))
+        tables = [name for (name,) in conn.execute("SELECT name FROM main.sqlite_master WHERE type = 'table'")]
+        previous_tables = {name for (name,) in conn.execute("SELECT name FROM previous.sqlite_master")}
+        for table in tables:
+            columns = [row[1] for row in conn.execute(f'PRAGMA main.table_info("{table}")')]
+            if table not in previous_tables:
+                yield from (_insert(table, row) for row in conn.execute(f'SELECT * FROM main."{table}"'))
+                continue
+            removed = f'SELECT * FROM previous."{table}" EXCEPT SELECT * FROM main."{table}"'
+            added = f'SELECT * FROM main."{table}" EXCEPT SELECT * FROM previous."{table}"'
+            yield from (_delete(table, columns, row) for row in conn.execute(removed))
+            yield from (_insert(table, row) for row in conn.execute(added))
+    finally:
+        conn.close()
+
+
+def _insert(table: str, row: tuple) -> str:
+    return f'INSERT INTO "{table}" VALUES ({", ".join(_literal(value) for value in row)});'
+
+
+def _delete(table: str, columns: list[str], row: tuple) -> str:
+    conditions = " AND ".join(f'"{column}" IS {_literal(value)}' for column, value in zip(columns, row))
+    return f'DELETE FROM "{table}" WHERE rowid = (SELECT rowid FROM "{table}" WHERE {conditions} LIMIT 1);'
+
+
+def _literal(value: object) -> str:
+    if value is None:
+        return "NULL"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, bytes):
+        return f"X'{value.hex()}'"
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def _snapshots() -> list[Path]:
+    """Returns the snapshots oldest first, their names start with when they were taken."""
+    paths = [
+        path
+        for path in Path(BACKUP_DIR).glob("*.gz")
+        if path.name.endswith(FULL_SUFFIX) or path.name.endswith(INCREMENTAL_SUFFIX)
+    ]
+    return sorted(paths, key=lambda path: path.name)
+
+
+def _base_path(snapshot_path: Path) -> str:
+    return BACKUP_DIR + snapshot_path.name.split(".")[0] + BASE_SUFFIX
+
+
+def _remove_leftovers(keep: str) -> None:
+    """Removes the copies of older snapshots and anything left behind by a snapshot that was never finished."""
+    for path in [*Path(BACKUP_DIR).glob("*" + BASE_SUFFIX), *Path(BACKUP_DIR).glob("*.tmp")]:
+        if path.name != Path(keep).name:
+            path.unlink()
+
+
+def _since_full() -> int:
+    """Returns how many incremental snapshots have been taken since the last full one."""
+    count = 0
+    for path in reversed(_snapshots()):
+        if path.name.endswith(FULL_SUFFIX):
+            return count
+        count += 1
+    return count
+
+
+def _rotate() -> None:
+    """Removes the oldest snapshots past KEEP, never leaving an incremental snapshot without its full one."""
+    snapshots = _snapshots()
+    excess = snapshots[: max(len(snapshots) - KEEP, 0)]
+    keep_from = len(excess)
+    while keep_from > 0 and not snapshots[keep_from].name.endswith(FULL_SUFFIX):
+        keep_from -= 1  # The oldest kept snapshot has to be a full one
+    for path in snapshots[:keep_from]:
+        path.unlink()
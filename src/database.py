@@ -1,28 +1,85 @@
 """Contains the Data struct stored in the database and methods for interacting with the database.
-The database is stored as a pickle file."""
+The database is stored as a SQLite file in WAL mode. All of it is cached in memory so reads never touch the disk,
+changes are applied to the cache right away and written to the file in batches by a background thread.
+Every batch is appended to a journal and synced to disk first, so changes the background thread hasn't written yet
+survive a crash and are replayed the next time the database is created.
+The file's schema is versioned with SQLite's user_version, create() upgrades older files through _MIGRATIONS."""
 
 from __future__ import annotations
 
+import json
+import logging
 import os
 import pickle
+import re
+import sqlite3
+from bisect import bisect_right
+from contextlib import contextmanager
 from dataclasses import dataclass, field
-from datetime import datetime, time, timedelta
-from threading import Lock
-from typing import TYPE_CHECKING, Final, Optional
+from datetime import date, datetime, time, timedelta, timezone
+from threading import Event, Lock, RLock, Thread, local
+from time import sleep
+from typing import TYPE_CHECKING, Callable, Final, Iterable, Iterator, Optional, TextIO
 
+import metrics
 from google_calendar import CalendarEvent
 
 if TYPE_CHECKING:
     from doorbell import Doorbell
 
-
-_LOCK: Final = Lock()
-FILE_PATH: Final = "data.pickle"
+logger = logging.getLogger(__name__)
+_LOCK: Final = RLock()  # Guards the cache and creating, migrating and deleting the database file
+_CONNECTIONS: Final = local()  # One connection per thread, SQLite connections can't be shared between threads
+FILE_PATH: Final = "data.db"
+LEGACY_FILE_PATH: Final = "data.pickle"
+JOURNAL_PATH: Final = "data.journal"
+FLUSH_DELAY_SECONDS: Final = 1.0
+MAX_RETRY_SECONDS: Final = 60.0  # Longest the flusher backs off for when writes keep failing
+COMPACT_ENTRIES: Final = 256  # Journal entries before the flusher drops the ones it no longer needs
+SCHEMA_VERSION: Final = 2
+_EPOCH: Final = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_MICROSECOND: Final = timedelta(microseconds=1)
+# Version 1 of the schema, _MIGRATIONS upgrades it from there
+_SCHEMA: Final = """
+CREATE TABLE IF NOT EXISTS schedule (
+    day INTEGER NOT NULL,
+    start_time TEXT,
+    end_time TEXT
+);
+CREATE TABLE IF NOT EXISTS schedule_overrides (
+    date TEXT NOT NULL,
+    start_time TEXT,
+    end_time TEXT
+);
+CREATE TABLE IF NOT EXISTS subscriptions (
+    channel_id TEXT NOT NULL,
+    calendar_name TEXT NOT NULL,
+    remind_seconds REAL NOT NULL,
+    next_event_name TEXT,
+    next_event_start TEXT,
+    next_event_end TEXT,
+    last_event TEXT NOT NULL,
+    PRIMARY KEY (channel_id, calendar_name)
+);
+CREATE TABLE IF NOT EXISTS roles (
+    role TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS user_roles (
+    user TEXT NOT NULL,
+    role TEXT NOT NULL,
+    PRIMARY KEY (user, role)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
 
 
 @dataclass(frozen=True)
 class DaySchedule:
-    """The schedule for a single day."""
+    """A window of time during a day that Doorbell runs. If end_time is before start_time
+    the window goes past midnight into the next day."""
 
     start_time: time
     end_time: time
@@ -39,20 +96,124 @@ class Subscription:
     last_event: datetime
 
 
+class RoleIndex:
+    """A reverse index from roles to the users that have them along with
+    a single compiled pattern that finds every role mentioned in a message."""
+
+    def __init__(self, roles: Iterable[str] = (), user_roles: Optional[dict[str, set[str]]] = None) -> None:
+        self.users: dict[str, set[str]] = {role: set() for role in roles}  # Role: Users
+        for user, user_role_set in (user_roles or {}).items():
+            for role in user_role_set:
+                self.users.setdefault(role, set()).add(user)
+        self._mentions: dict[str, set[str]] = {}  # Lowercase Role: Users
+        for role in roles:
+            self._mentions.setdefault(role.lower(), set()).update(self.users[role])
+        self._pattern: Optional[re.Pattern[str]] = None
+        if self._mentions:
+            alternatives = "|".join(re.escape(role) for role in sorted(self._mentions, key=len, reverse=True))
+            self._pattern = re.compile(rf"@({alternatives})(?!\w)", re.IGNORECASE)
+
+    def mentioned_users(self, text: str) -> set[str]:
+        """Returns the users that have any of the roles mentioned (@role) in the text."""
+        users: set[str] = set()
+        if self._pattern is None:
+            return users
+        for role in self._pattern.findall(text):
+            users.update(self._mentions[role.lower()])
+        return users
+
+
+class WeeklySchedule:
+    """The weekly schedule flattened into sorted, non-overlapping intervals of seconds since Monday at midnight
+    so that whether Doorbell is running can be found with a binary search. Overrides replace the weekly
+    windows for a specific date, e.g. an empty list of windows for a holiday."""
+
+    WEEK_SECONDS: Final = 7 * 24 * 60 * 60
+    DAY_SECONDS: Final = 24 * 60 * 60
+
+    def __init__(
+        self,
+        days: Iterable[Iterable[DaySchedule]] = (),
+        overrides: Optional[dict[date, list[DaySchedule]]] = None,
+    ) -> None:
+        intervals = []
+        for day, windows in enumerate(days):
+            for window in windows:
+                start = day * self.DAY_SECONDS + self._seconds(window.start_time)
+                end = day * self.DAY_SECONDS + self._seconds(window.end_time)
+                if end < start:
+                    end += self.DAY_SECONDS
+                if end >= self.WEEK_SECONDS:  # Sunday night into Monday morning
+                    intervals.append((0.0, end - self.WEEK_SECONDS))
+                    end = self.WEEK_SECONDS - 1e-6
+                intervals.append((start, end))
+        self._starts, self._ends = self._merge(intervals)
+        self._overrides = {  # Date: (Starts, Ends) in seconds since that date's midnight
+            day: self._merge((self._seconds(w.start_time), self._end_of(w)) for w in windows)
+            for day, windows in (overrides or {}).items()
+        }
+
+    def is_open(self, when: datetime) -> bool:
+        """Returns whether Doorbell is supposed to run at a time."""
+        override = self._overrides.get(when.date())
+        if override is not None:
+            return self._contains(*override, self._seconds(when.time()))
+        return self._contains(self._starts, self._ends, when.weekday() * self.DAY_SECONDS + self._seconds(when.time()))
+
+    def _contains(self, starts: list[float], ends: list[float], seconds: float) -> bool:
+        i = bisect_right(starts, seconds) - 1
+        return i >= 0 and seconds <= ends[i]
+
+    def _merge(self, intervals: Iterable[tuple[float, float]]) -> tuple[list[float], list[float]]:
+        starts: list[float] = []
+        ends: list[float] = []
+        for start, end in sorted(intervals):
+            if ends and start <= ends[-1]:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        return starts, ends
+
+    def _end_of(self, window: DaySchedule) -> float:
+        if window.end_time < window.start_time:  # Overrides only cover their own date
+            return self.DAY_SECONDS - 1e-6
+        return self._seconds(window.end_time)
+
+    def _seconds(self, of: time) -> float:
+        return of.hour * 3600 + of.minute * 60 + of.second + of.microsecond / 1e6
+
+
 @dataclass
 class Data:
     """The Data object being stored in the database."""
 
-    schedule: list[Optional[DaySchedule]] = field(default_factory=list)  # 7 days long, starts at Monday
-    subscriptions: list[Subscription] = field(default_factory=list)
+    schedule: list[list[DaySchedule]] = field(default_factory=list)  # 7 days long, starts at Monday
+    schedule_overrides: dict[date, list[DaySchedule]] = field(default_factory=dict)  # Date: Windows
+    subscriptions: dict[tuple[str, str], Subscription] = field(default_factory=dict)  # (Channel, Calendar): Sub
     roles: set[str] = field(default_factory=set)
     user_roles: dict[str, set[str]] = field(default_factory=dict)  # User: Roles
+    # Derived from roles and user_roles, only rebuilt by index_roles() when they change
+    role_index: RoleIndex = field(default_factory=RoleIndex, init=False, repr=False, compare=False)
+    # Derived from schedule and schedule_overrides, only rebuilt by index_schedule() when they change
+    weekly_schedule: WeeklySchedule = field(default_factory=WeeklySchedule, init=False, repr=False, compare=False)
+    # Derived from subscriptions, kept up to date by add_subscription() and remove_subscription()
+    subscriptions_by_channel: dict[str, dict[str, Subscription]] = field(  # Channel: {Calendar: Sub}
+        default_factory=dict, init=False, repr=False, compare=False
+    )
+    subscriptions_by_calendar: dict[str, dict[str, Subscription]] = field(  # Calendar: {Channel: Sub}
+        default_factory=dict, init=False, repr=False, compare=False
+    )
+
+    def __post_init__(self) -> None:
+        self.index_subscriptions()
+        self.index_schedule()
 
     def schedule_to_str(self) -> str:
-        """Formats the internal schedule as a pretty string."""
+        """Formats the internal schedule and any upcoming overrides as a pretty string."""
         if not self.schedule:
             return "No schedule."
-        return (
+        week = (
             f"Mo: {self._day_to_str(self.schedule[0])}"
             + f" | Tu: {self._day_to_str(self.schedule[1])}"
             + f" | We: {self._day_to_str(self.schedule[2])}"
@@ -61,58 +222,106 @@ class Data:
             + f" | Sa: {self._day_to_str(self.schedule[5])}"
             + f" | Su: {self._day_to_str(self.schedule[6])}"
         )
+        today = date.today()
+        overrides = [
+            f"{day.isoformat()}: {self._day_to_str(windows)}"
+            for day, windows in sorted(self.schedule_overrides.items())
+            if day >= today
+        ]
+        return "\n".join([week, *overrides])
+
+    def is_open(self, when: datetime) -> bool:
+        """Returns whether Doorbell is supposed to run at a time."""
+        return self.weekly_schedule.is_open(when)
+
+    def index_schedule(self) -> None:
+        """Rebuilds the weekly schedule, needs to be called whenever schedule or schedule_overrides change."""
+        self.weekly_schedule = WeeklySchedule(self.schedule, self.schedule_overrides)
 
     def all_subscriptions_to_str(self, doorbell: Doorbell) -> str:
         """Formats all the internal subscriptions as a pretty string."""
-        if not self.subscriptions:
+        channel_ids = list(self.subscriptions_by_channel)
+        if not channel_ids:
             return "No subscriptions."
-        string = "All Subscriptions:\n"
-        channel_ids = set()
-        for sub in self.subscriptions:
-            channel_ids.add(sub.channel_id)
+        lines = ["All Subscriptions:"]
         for channel_id in channel_ids:
-            string += doorbell.get_channel_name(channel_id) + " " + self.subscriptions_to_str(channel_id) + "\n"
-        return string.strip()
+            lines.append(f"{doorbell.get_channel_name(channel_id)} {self.subscriptions_to_str(channel_id)}")
+        return "\n".join(lines)
 
     def subscriptions_to_str(self, channel_id: str) -> str:
         """Formats the internal subscriptions for a given channel as a pretty string."""
         subs = self.subscriptions_for_channel(channel_id)
         if not subs:
             return "No subscriptions."
-        string = "Subscriptions:\n"
+        lines = ["Subscriptions:"]
         for sub in subs:
             name = "None" if sub.next_event is None else sub.next_event.name
-            string += (
-                f"{sub.calendar_name}: {sub.remind_time.total_seconds() / 3600} hours, next reminder is for {name}\n"
+            lines.append(
+                f"{sub.calendar_name}: {sub.remind_time.total_seconds() / 3600} hours, next reminder is for {name}"
             )
-        return string.strip()
+        return "\n".join(lines)
 
     def subscriptions_for_channel(self, channel_id: str) -> list[Subscription]:
         """Returns all the subscriptions within a given Slack channel."""
-        subs = []
-        for sub in self.subscriptions:
-            if sub.channel_id == channel_id:
-                subs.append(sub)
-        return subs
+        return list(self.subscriptions_by_channel.get(channel_id, {}).values())
+
+    def subscriptions_for_calendar(self, calendar_name: str) -> list[Subscription]:
+        """Returns all the subscriptions to a given calendar."""
+        return list(self.subscriptions_by_calendar.get(calendar_name, {}).values())
+
+    def get_subscription(self, channel_id: str, calendar_name: str) -> Optional[Subscription]:
+        """Returns a channel's subscription to a calendar or None if there isn't one."""
+        return self.subscriptions.get((channel_id, calendar_name))
+
+    def add_subscription(self, sub: Subscription) -> bool:
+        """Adds a subscription, returns False if the channel is already subscribed to that calendar."""
+        key = (sub.channel_id, sub.calendar_name)
+        if key in self.subscriptions:
+            return False
+        self.subscriptions[key] = sub
+        self.subscriptions_by_channel.setdefault(sub.channel_id, {})[sub.calendar_name] = sub
+        self.subscriptions_by_calendar.setdefault(sub.calendar_name, {})[sub.channel_id] = sub
+        return True
+
+    def remove_subscription(self, channel_id: str, calendar_name: str) -> Optional[Subscription]:
+        """Removes a subscription and returns it, or None if there was no such subscription."""
+        sub = self.subscriptions.pop((channel_id, calendar_name), None)
+        if sub is None:
+            return None
+        for index, outer, inner in (
+            (self.subscriptions_by_channel, channel_id, calendar_name),
+            (self.subscriptions_by_calendar, calendar_name, channel_id),
+        ):
+            del index[outer][inner]
+            if not index[outer]:
+                del index[outer]
+        return sub
+
+    def index_subscriptions(self) -> None:
+        """Rebuilds the subscription indexes, needs to be called if subscriptions is changed directly."""
+        self.subscriptions_by_channel = {}
+        self.subscriptions_by_calendar = {}
+        for sub in self.subscriptions.values():
+            self.subscriptions_by_channel.setdefault(sub.channel_id, {})[sub.calendar_name] = sub
+            self.subscriptions_by_calendar.setdefault(sub.calendar_name, {})[sub.channel_id] = sub
 
     def add_role(self, role: str) -> None:
         """Adds a role to the database."""
         self.roles.add(role)
+        self.index_roles()
 
     def remove_role(self, role: str) -> None:
         """Removes a role from the database and removes it from all users that previously held that role."""
         if role in self.roles:
             self.roles.remove(role)
             for user in self.get_users_for_role(role):
-                roles = self.get_roles_for_user(user)
-                roles.remove(role)
-                self.set_roles(user, roles)
+                self.user_roles[user] = self.get_roles_for_user(user) - {role}
+            self.index_roles()
 
     def set_roles(self, user: str, roles: set[str]):
         """Sets the roles of a user. These should be roles found through get_roles()."""
-        if user not in self.user_roles:
-            self.user_roles[user] = set()
         self.user_roles[user] = roles
+        self.index_roles()
 
     def get_roles_for_user(self, user: str) -> set[str]:
         """Returns the roles that a user has."""
@@ -122,67 +331,669 @@ class Data:
 
     def get_users_for_role(self, role: str) -> set[str]:
         """Returns the users that have a specific role."""
-        users = set()
-        for user, roles in self.user_roles.items():
-            if role in roles:
-                users.add(user)
-        return users
+        return self.role_index.users.get(role, set())
+
+    def get_users_for_mentions(self, text: str) -> set[str]:
+        """Returns the users that have any of the roles mentioned (@role) in a message."""
+        return self.role_index.mentioned_users(text)
+
+    def index_roles(self) -> None:
+        """Rebuilds the role index, needs to be called whenever roles or user_roles change."""
+        self.role_index = RoleIndex(self.roles, self.user_roles)
 
     def get_roles(self) -> set[str]:
         """Returns all of the roles."""
         return self.roles
 
-    def _day_to_str(self, day: Optional[DaySchedule]) -> str:
+    def _day_to_str(self, windows: list[DaySchedule]) -> str:
         time_format = "%I:%M %p"
-        if day is None:
+        if not windows:
             return "--"
-        return f"{day.start_time.strftime(time_format)} - {day.end_time.strftime(time_format)}"
+        return ", ".join(
+            f"{window.start_time.strftime(time_format)} - {window.end_time.strftime(time_format)}" for window in windows
+        )
 
 
 def create() -> None:
-    """Creates a pickle file containing the database if it doesn't exist."""
-    if not os.path.exists(FILE_PATH):
-        write(Data())
+    """Creates the SQLite file containing the database if it doesn't exist and starts the background flusher.
+    If an old pickle database is found it's migrated into the new one. Any changes in the journal that didn't
+    make it into the file before Doorbell last stopped are replayed."""
+    with _LOCK:
+        exists = os.path.exists(FILE_PATH)
+        try:
+            _connection().executescript(_SCHEMA)
+            _replay_journal()
+            _migrate(_connection(), SCHEMA_VERSION)
+        except sqlite3.DatabaseError:  # check_for_corruption() recovers it
+            logger.exception("Couldn't replay %s into %s.", JOURNAL_PATH, FILE_PATH)
+        if not exists and os.path.exists(LEGACY_FILE_PATH):
+            _migrate_from_pickle()
+    _FLUSHER.start_once()
 
 
 def read() -> Data:
-    """Reads data from the pickle file containing the database."""
-    with _LOCK:
-        with open(FILE_PATH, "rb") as f:
-            return pickle.load(f)
+    """Returns the cached data, loading it from the database the first time.
+    The returned Data is shared so it should only be changed through the functions in this module."""
+    data = _CACHE.data
+    if data is None:
+        with _LOCK:
+            if _CACHE.data is None:
+                _CACHE.data = _load()
+            data = _CACHE.data
+    return data
 
 
 def write(data: Data) -> None:
-    """Writes data to the pickle file containing the database."""
+    """Replaces everything in the database with data.
+    Prefer the row-level functions below when only part of the data changes."""
+    data.index_roles()
+    data.index_subscriptions()
+    data.index_schedule()
     with _LOCK:
-        with open(FILE_PATH, "wb") as f:
-            pickle.dump(data, f)
+        _CACHE.data = data
+        _mark_dirty(
+            ("DELETE FROM subscriptions", [()]),
+            ("DELETE FROM roles", [()]),
+            ("DELETE FROM user_roles", [()]),
+            *_schedule_statements(data.schedule),
+            ("DELETE FROM schedule_overrides", [()]),
+            (
+                "INSERT INTO schedule_overrides VALUES (?, ?, ?)",
+                [row for day, windows in data.schedule_overrides.items() for row in _override_rows(day, windows)],
+            ),
+            (
+                "INSERT INTO subscriptions VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [_subscription_to_row(s) for s in data.subscriptions.values()],
+            ),
+            ("INSERT INTO roles VALUES (?)", [(role,) for role in data.roles]),
+            (
+                "INSERT INTO user_roles VALUES (?, ?)",
+                [(user, role) for user, roles in data.user_roles.items() for role in roles],
+            ),
+        )
 
 
-def delete() -> None:
-    """Deletes the pickle file containing the database."""
+def set_schedule(schedule: list[list[DaySchedule]]) -> None:
+    """Replaces the weekly schedule."""
+    data = read()
+    with _LOCK:
+        data.schedule = schedule
+        data.index_schedule()
+        _mark_dirty(*_schedule_statements(schedule))
+
+
+def set_schedule_override(day: date, windows: Optional[list[DaySchedule]]) -> None:
+    """Replaces the weekly schedule on a specific date with other windows, no windows means Doorbell
+    doesn't run that day. Passing None removes the override."""
+    data = read()
+    with _LOCK:
+        overrides = dict(data.schedule_overrides)
+        if windows is None:
+            overrides.pop(day, None)
+        else:
+            overrides[day] = windows
+        data.schedule_overrides = overrides
+        data.index_schedule()
+        statements = [("DELETE FROM schedule_overrides WHERE date = ?", [(day.isoformat(),)])]
+        if windows is not None:
+            statements.append(("INSERT INTO schedule_overrides VALUES (?, ?, ?)", _override_rows(day, windows)))
+        _mark_dirty(*statements)
+
+
+def add_subscription(sub: Subscription) -> bool:
+    """Adds a subscription, returns False if the channel is already subscribed to that calendar."""
+    data = read()
     with _LOCK:
-        if os.path.exists(FILE_PATH):
-            os.remove(FILE_PATH)
+        if not data.add_subscription(sub):
+            return False
+        _mark_dirty(("INSERT INTO subscriptions VALUES (?, ?, ?, ?, ?, ?, ?)", [_subscription_to_row(sub)]))
+        return True
 
 
-def get_copy() -> bytearray:
-    """Returns a bytearray with a copy of the database's (pickle file) contents."""
+def update_subscription(sub: Subscription) -> None:
+    """Saves the next and last event of a subscription after they've been changed. Does nothing if the
+    subscription has been removed or replaced since, so a stale copy never overwrites the live one."""
+    data = read()
     with _LOCK:
-        buffer = bytearray(os.path.getsize(FILE_PATH))
-        with open(FILE_PATH, "rb") as f:
-            f.readinto1(buffer)
-        return buffer
+        if data.get_subscription(sub.channel_id, sub.calendar_name) is not sub:
+            return
+        row = _subscription_to_row(sub)
+        _mark_dirty(
+            (
+                "UPDATE subscriptions SET remind_seconds = ?, next_event_name = ?, next_event_start = ?,"
+                " next_event_end = ?, last_event = ? WHERE channel_id = ? AND calendar_name = ?",
+                [(*row[2:], *row[:2])],
+            )
+        )
+
+
+def remove_subscription(channel_id: str, calendar_name: str) -> bool:
+    """Removes a subscription, returns False if there was no such subscription."""
+    data = read()
+    with _LOCK:
+        if data.remove_subscription(channel_id, calendar_name) is None:
+            return False
+        _mark_dirty(
+            ("DELETE FROM subscriptions WHERE channel_id = ? AND calendar_name = ?", [(channel_id, calendar_name)])
+        )
+        return True
+
 
+# Roles are replaced instead of changed in place so that readers can iterate over them without locking
 
-def check_for_corruption() -> None:
-    """Attempts to read the pickle file and if there's an error
-    the old database will be deleted and a new one created."""
+
+def add_roles(roles: Iterable[str]) -> None:
+    """Adds roles to the database."""
+    params = [(role,) for role in roles]
+    data = read()
+    with _LOCK:
+        data.roles = data.roles.union(role for (role,) in params)
+        data.index_roles()
+        _mark_dirty(("INSERT OR IGNORE INTO roles VALUES (?)", params))
+
+
+def remove_roles(roles: Iterable[str]) -> None:
+    """Removes roles from the database and from all users that previously held them."""
+    params = [(role,) for role in roles]
+    removed = {role for (role,) in params}
+    data = read()
+    with _LOCK:
+        data.roles = data.roles - removed
+        data.user_roles = {user: user_roles - removed for user, user_roles in data.user_roles.items()}
+        data.index_roles()
+        _mark_dirty(("DELETE FROM roles WHERE role = ?", params), ("DELETE FROM user_roles WHERE role = ?", params))
+
+
+def set_user_roles(user: str, roles: set[str]) -> None:
+    """Sets the roles of a user. These should be roles found through Data.get_roles()."""
+    data = read()
+    with _LOCK:
+        data.user_roles = {**data.user_roles, user: set(roles)}
+        data.index_roles()
+        _mark_dirty(
+            ("DELETE FROM user_roles WHERE user = ?", [(user,)]),
+            ("INSERT INTO user_roles VALUES (?, ?)", [(user, role) for role in roles]),
+        )
+
+
+def flush() -> None:
+    """Writes any pending changes to the database file right away."""
+    with _FLUSH_LOCK:
+        with _LOCK:
+            statements = _CACHE.pending
+            position = _JOURNAL.position
+            _CACHE.pending = []
+        if not statements:
+            return
+        try:
+            with metrics.timed("database_write"), _transaction() as conn:
+                _apply(conn, statements, position)
+        except sqlite3.Error:
+            with _LOCK:  # Put them back to be retried with the next batch
+                _CACHE.pending[:0] = statements
+            raise
+        _CACHE.written = position
+
+
+def close() -> None:
+    """Stops the background flusher and writes any pending changes."""
+    _FLUSHER.stop()
+    flush()
+    _JOURNAL.close()
+
+
+def delete() -> None:
+    """Deletes the SQLite file containing the database along with its journal."""
+    with _LOCK:
+        _CACHE.data = None
+        _CACHE.pending = []
+        _close_connection()
+        _JOURNAL.close()
+        _JOURNAL.position = 0
+        for path in (FILE_PATH, FILE_PATH + "-wal", FILE_PATH + "-shm", JOURNAL_PATH):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def check_for_corruption(restore: Optional[Callable[[str], None]] = None) -> None:
+    """Checks the integrity of the SQLite file and if there's an error the database is rebuilt from its last
+    good state: restore(path) is called to write the latest backup to path, then the journal is replayed on top.
+    The corrupted file is kept next to the new one instead of being deleted."""
     try:
-        data = read()
-        if vars(data).keys() != vars(Data()).keys():
-            raise AttributeError()
-    except AttributeError:  # Corrupted / Structure changed
-        print("Couldn't read database, recreating...")
-        delete()
+        result = _connection().execute("PRAGMA quick_check").fetchone()
+        if result is None or result[0] != "ok":
+            raise sqlite3.DatabaseError(result)
+        _load()
+    except (sqlite3.DatabaseError, ValueError):  # Corrupted / Structure changed
+        logger.exception("Couldn't read database, recovering...")
+        _recover(restore)
+
+
+def journal_position(path: str = FILE_PATH) -> int:
+    """Returns the number of the last journal entry written to the database file at path."""
+    conn = sqlite3.connect(path)
+    try:
+        return _position(conn)
+    finally:
+        conn.close()
+
+
+def schema_version(path: str = FILE_PATH) -> int:
+    """Returns the schema version of the database file at path."""
+    conn = sqlite3.connect(path)
+    try:
+        return _schema_version(conn)
+    finally:
+        conn.close()
+
+
+def backed_up(position: int) -> None:
+    """Records that a backup has every journal entry up to position, so the journal can drop them.
+    Until then they're kept, since recovering from that backup needs them."""
+    with _transaction() as conn:
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('backed_up', ?)", (position,))
+    _CACHE.backed_up = position
+
+
+def backup_position() -> Optional[int]:
+    """Returns the position of the last journal entry in a backup, None if there's no backup yet."""
+    return _CACHE.backed_up
+
+
+def replace_atomically(source: str, destination: str) -> None:
+    """Moves the file at source over destination after syncing it to disk, so that destination is
+    either the old file or the complete new one even if Doorbell or the machine dies halfway."""
+    with open(source, "rb+") as f:
+        os.fsync(f.fileno())
+    os.replace(source, destination)
+    if os.name != "nt":  # The rename itself is only durable once the directory is synced, Windows can't do that
+        directory = os.open(os.path.dirname(os.path.abspath(destination)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+
+class _Cache:
+    """The process wide copy of the database and the statements that haven't been written to it yet."""
+
+    def __init__(self) -> None:
+        self.data: Optional[Data] = None
+        self.pending: list[tuple[str, list[tuple]]] = []
+        self.dirty = Event()
+        self.written = 0  # Position of the last journal entry written to the database file
+        self.backed_up: Optional[int] = None  # Position of the last journal entry in a backup, if there is one
+
+
+class _Journal:
+    """An append-only file of the batches of statements passed to _mark_dirty(), one JSON line each, numbered in
+    order. The database file stores the number, or position, of the last one it has in its meta table."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.position = 0
+        self.entries = 0
+        self.oldest: Optional[int] = None  # Position of the first entry in the file
+        self._file: Optional[TextIO] = None
+
+    def append(self, statements: tuple[tuple[str, list[tuple]], ...]) -> None:
+        """Appends a batch and syncs it to disk before returning."""
+        if self._file is None:
+            self._file = open(self.path, "a+", encoding="utf-8")  # pylint: disable=consider-using-with
+            if self._file.tell() > 0:
+                self._file.seek(self._file.tell() - 1)
+                if self._file.read(1) != "\n":  # Don't glue onto a line that was cut off by a crash
+                    self._file.write("\n")
+        self.position += 1
+        line = [self.position, statements, SCHEMA_VERSION]  # The schema the statements were written against
+        self._file.write(json.dumps(line, separators=(",", ":")) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.entries += 1
+        if self.oldest is None:
+            self.oldest = self.position
+
+    def read(self) -> list[tuple[int, list[tuple[str, list[tuple]]], int]]:
+        """Returns every batch in the file with its position. Lines that were cut off by a crash are skipped."""
+        batches = []
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        position, statements, *version = json.loads(line)  # Older entries don't have a version
+                    except ValueError:
+                        logger.warning("Skipping a partially written entry in %s.", self.path)
+                        continue
+                    statements = [(sql, [tuple(row) for row in rows]) for sql, rows in statements]
+                    batches.append((position, statements, version[0] if version else 1))
+        except FileNotFoundError:
+            pass
+        self.entries = len(batches)
+        self.oldest = batches[0][0] if batches else None
+        return batches
+
+    @metrics.timed("database_compact")
+    def compact(self, through: int) -> None:
+        """Rewrites the file without the batches up to and including position through.
+        The new file replaces the old one atomically, so a crash leaves one or the other."""
+        kept = [batch for batch in self.read() if batch[0] > through]
+        self.close()
+        temporary = self.path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            for batch in kept:
+                f.write(json.dumps(batch, separators=(",", ":")) + "\n")
+        replace_atomically(temporary, self.path)
+        self.entries = len(kept)
+        self.oldest = kept[0][0] if kept else None
+
+    def close(self) -> None:
+        """Closes the file, the next append() reopens it."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class _Flusher(Thread):
+    """Writes pending changes to the database in batches, waiting FLUSH_DELAY_SECONDS after
+    the first change so that bursts of changes become a single transaction. Batches that fail
+    are retried with exponential backoff up to MAX_RETRY_SECONDS."""
+
+    def __init__(self) -> None:
+        super().__init__(target=self._continuously_flush, name="Database Flusher", daemon=True)
+        self.stopped = False
+
+    def start_once(self) -> None:
+        """Starts this thread if it hasn't been started already."""
+        with _LOCK:
+            if not self.is_alive() and not self.stopped:
+                self.start()
+
+    def stop(self) -> None:
+        """Stops this thread."""
+        self.stopped = True
+        _CACHE.dirty.set()
+
+    def _continuously_flush(self) -> None:
+        retry_seconds = FLUSH_DELAY_SECONDS
+        while not self.stopped:
+            _CACHE.dirty.wait()
+            sleep(FLUSH_DELAY_SECONDS)
+            _CACHE.dirty.clear()
+            try:
+                flush()
+            except sqlite3.Error:
+                logger.exception("Couldn't write to the database, retrying in %.0f seconds.", retry_seconds)
+                _CACHE.dirty.set()  # flush() put the batch back
+                sleep(retry_seconds)
+                retry_seconds = min(retry_seconds * 2, MAX_RETRY_SECONDS)
+                continue
+            retry_seconds = FLUSH_DELAY_SECONDS
+            _compact_journal()
+
+
+_CACHE: Final = _Cache()
+_JOURNAL: Final = _Journal(JOURNAL_PATH)
+_FLUSH_LOCK: Final = Lock()  # Keeps batches in order when flush() is called outside of the flusher
+_FLUSHER: Final = _Flusher()
+
+
+def _compact_journal() -> None:
+    """Drops the journal entries that both the database file and the latest backup have, once there are more than
+    COMPACT_ENTRIES. Nothing is dropped until there's a backup, recovering a corrupted database would need them."""
+    if _CACHE.backed_up is None or _JOURNAL.oldest is None or _JOURNAL.entries <= COMPACT_ENTRIES:
+        return
+    through = min(_CACHE.written, _CACHE.backed_up)
+    if through < _JOURNAL.oldest:
+        return  # Nothing to drop until the next backup
+    with _LOCK:  # Nothing can be appended while it's being rewritten
+        _JOURNAL.compact(through)
+
+
+def _mark_dirty(*statements: tuple[str, list[tuple]]) -> None:
+    """Journals statements and queues them to be written by the flusher, must be called while holding _LOCK."""
+    _JOURNAL.append(statements)
+    _CACHE.pending.extend(statements)
+    _CACHE.dirty.set()
+
+
+@metrics.timed("database_read")
+def _load() -> Data:
+    conn = _connection()
+    data = Data()
+    days = conn.execute("SELECT day, start_time, end_time FROM schedule ORDER BY day, start_time").fetchall()
+    if days:
+        data.schedule = [[] for _ in range(7)]
+        for day, start, end in days:
+            if start is not None and end is not None:
+                data.schedule[day].append(DaySchedule(time.fromisoformat(start), time.fromisoformat(end)))
+    for day, start, end in conn.execute("SELECT * FROM schedule_overrides ORDER BY date, start_time"):
+        windows = data.schedule_overrides.setdefault(date.fromisoformat(day), [])
+        if start is not None and end is not None:
+            windows.append(DaySchedule(time.fromisoformat(start), time.fromisoformat(end)))
+    data.index_schedule()
+    for row in conn.execute("SELECT * FROM subscriptions ORDER BY rowid"):
+        data.add_subscription(_row_to_subscription(row))
+    data.roles = {role for (role,) in conn.execute("SELECT role FROM roles")}
+    for user, role in conn.execute("SELECT user, role FROM user_roles"):
+        data.user_roles.setdefault(user, set()).add(role)
+    data.index_roles()
+    return data
+
+
+def _connection() -> sqlite3.Connection:
+    conn: Optional[sqlite3.Connection] = getattr(_CONNECTIONS, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(FILE_PATH, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")  # The journal drops entries once they're written
+        _CONNECTIONS.conn = conn
+    return conn
+
+
+def _close_connection() -> None:
+    conn: Optional[sqlite3.Connection] = getattr(_CONNECTIONS, "conn", None)
+    if conn is not None:
+        conn.close()
+        _CONNECTIONS.conn = None
+
+
+@contextmanager
+def _transaction() -> Iterator[sqlite3.Connection]:
+    conn = _connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def _apply(conn: sqlite3.Connection, statements: list[tuple[str, list[tuple]]], position: int) -> None:
+    for sql, params in statements:
+        conn.executemany(sql, params)
+    conn.execute("INSERT OR REPLACE INTO meta VALUES ('journal', ?)", (position,))
+
+
+def _position(conn: sqlite3.Connection, key: str = "journal") -> int:
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return 0 if row is None else row[0]
+
+
+def _replay_journal() -> None:
+    """Writes the journal entries the database file doesn't have yet, must be called while holding _LOCK."""
+    conn = _connection()
+    written = _position(conn)
+    _CACHE.written = written
+    _CACHE.backed_up = _position(conn, "backed_up") or None
+    batches = _JOURNAL.read()
+    _JOURNAL.position = max([written, *(batch[0] for batch in batches)])
+    missing = [batch for batch in batches if batch[0] > written]
+    if not missing:
+        return
+    if missing[0][0] > written + 1:
+        logger.error(
+            "%s only has changes up to %d and %s starts at %d, the changes in between are lost.",
+            FILE_PATH,
+            written,
+            JOURNAL_PATH,
+            missing[0][0],
+        )
+    with metrics.timed("database_replay"):
+        for position, statements, version in missing:
+            _migrate(conn, version)  # Entries from before an upgrade are replayed against the schema they were for
+            with _transaction():
+                _apply(conn, statements, position)
+    _CACHE.written = missing[-1][0]
+    logger.info("Replayed %d changes from %s into %s.", len(missing), JOURNAL_PATH, FILE_PATH)
+
+
+def _schema_version(conn: sqlite3.Connection) -> int:
+    return max(conn.execute("PRAGMA user_version").fetchone()[0], 1)  # Files from before versioning are 0
+
+
+def _migrate(conn: sqlite3.Connection, version: int) -> None:
+    """Upgrades the database file to version one migration at a time, each in its own transaction."""
+    for target in range(_schema_version(conn) + 1, version + 1):
+        with metrics.timed("database_migrate", version=str(target)), _transaction():
+            _MIGRATIONS[target](conn)
+            conn.execute(f"PRAGMA user_version = {target}")
+        logger.info("Migrated %s to version %d.", FILE_PATH, target)
+
+
+def _store_times_as_integers(conn: sqlite3.Connection) -> None:
+    """Version 2 stores the times of subscriptions as microseconds since the epoch instead of ISO 8601 text."""
+    conn.execute(
+        """CREATE TABLE subscriptions_v2 (
+            channel_id TEXT NOT NULL,
+            calendar_name TEXT NOT NULL,
+            remind_seconds REAL NOT NULL,
+            next_event_name TEXT,
+            next_event_start INTEGER,
+            next_event_end INTEGER,
+            last_event INTEGER NOT NULL,
+            PRIMARY KEY (channel_id, calendar_name)
+        )"""
+    )
+    rows = conn.execute("SELECT * FROM subscriptions ORDER BY rowid").fetchall()
+    conn.executemany(
+        "INSERT INTO subscriptions_v2 VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [
+            (*row[:4], *(None if value is None else _to_micros(datetime.fromisoformat(value)) for value in row[4:]))
+            for row in rows
+        ],
+    )
+    conn.execute("DROP TABLE subscriptions")
+    conn.execute("ALTER TABLE subscriptions_v2 RENAME TO subscriptions")
+
+
+_MIGRATIONS: Final[dict[int, Callable[[sqlite3.Connection], None]]] = {  # Version: Migration from the one before
+    2: _store_times_as_integers,
+}
+
+
+def _recover(restore: Optional[Callable[[str], None]]) -> None:
+    with _LOCK:
+        _CACHE.data = None
+        _close_connection()
+        corrupted = FILE_PATH + datetime.now().strftime(".%Y%m%d-%H%M%S.corrupted")
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(FILE_PATH + suffix):
+                os.replace(FILE_PATH + suffix, corrupted + suffix)
+        logger.info("Moved the corrupted database to %s.", corrupted)
+        if restore is not None:
+            restoring = FILE_PATH + ".restoring"
+            try:
+                restore(restoring)
+                replace_atomically(restoring, FILE_PATH)
+                logger.info("Restored %s from the latest backup.", FILE_PATH)
+            except (OSError, sqlite3.Error) as error:
+                logger.error("Couldn't restore a backup, only the journal will be replayed: %s", error)
+                if os.path.exists(restoring):
+                    os.remove(restoring)
         create()
+
+
+def _schedule_statements(schedule: list[list[DaySchedule]]) -> list[tuple[str, list[tuple]]]:
+    rows: list[tuple] = []
+    for i, windows in enumerate(schedule):
+        if not windows:
+            rows.append((i, None, None))  # Days without windows are still stored so the schedule stays 7 days
+        rows.extend((i, window.start_time.isoformat(), window.end_time.isoformat()) for window in windows)
+    return [("DELETE FROM schedule", [()]), ("INSERT INTO schedule VALUES (?, ?, ?)", rows)]
+
+
+def _override_rows(day: date, windows: list[DaySchedule]) -> list[tuple]:
+    if not windows:
+        return [(day.isoformat(), None, None)]
+    return [(day.isoformat(), window.start_time.isoformat(), window.end_time.isoformat()) for window in windows]
+
+
+def _subscription_to_row(sub: Subscription) -> tuple:
+    event = sub.next_event
+    return (
+        sub.channel_id,
+        sub.calendar_name,
+        sub.remind_time.total_seconds(),
+        None if event is None else event.name,
+        None if event is None else _to_micros(event.start),
+        None if event is None else _to_micros(event.end),
+        _to_micros(sub.last_event),
+    )
+
+
+def _row_to_subscription(row: tuple) -> Subscription:
+    channel_id, calendar_name, remind_seconds, name, start, end, last_event = row
+    next_event = None
+    if start is not None and end is not None:
+        next_event = CalendarEvent(name, _from_micros(start), _from_micros(end))
+    return Subscription(
+        channel_id, calendar_name, timedelta(seconds=remind_seconds), next_event, _from_micros(last_event)
+    )
+
+
+def _to_micros(when: datetime) -> int:
+    return (when.astimezone(timezone.utc) - _EPOCH) // _MICROSECOND  # Exact unlike timestamp()
+
+
+def _from_micros(micros: int) -> datetime:
+    return _EPOCH + timedelta(microseconds=micros)
+
+
+class _LegacyUnpickler(pickle.Unpickler):
+    """Only loads the classes an old pickle database is made of, so loading one can't run arbitrary code."""
+
+    ALLOWED: Final = {
+        ("builtins", "set"),
+        ("datetime", "date"),
+        ("datetime", "datetime"),
+        ("datetime", "time"),
+        ("datetime", "timedelta"),
+        ("datetime", "timezone"),
+        ("database", "Data"),
+        ("database", "DaySchedule"),
+        ("database", "Subscription"),
+        ("google_calendar", "CalendarEvent"),
+    }
+
+    def find_class(self, module: str, name: str) -> type:
+        if (module, name) not in self.ALLOWED:
+            raise pickle.UnpicklingError(f"{module}.{name} isn't allowed in {LEGACY_FILE_PATH}.")
+        return super().find_class(module, name)
+
+
+def _migrate_from_pickle() -> None:
+    try:
+        with open(LEGACY_FILE_PATH, "rb") as f:
+            legacy = _LegacyUnpickler(f).load()  # Its subscriptions are still a list
+        schedule = [[] if day is None else [day] for day in legacy.schedule]  # It has at most one window per day
+        data = Data(schedule, roles=legacy.roles, user_roles=legacy.user_roles)
+        for sub in legacy.subscriptions:
+            data.add_subscription(sub)
+        write(data)
+        flush()
+    except (pickle.UnpicklingError, AttributeError, EOFError) as error:
+        logger.error("Couldn't migrate %s: %s", LEGACY_FILE_PATH, error)
+        return
+    os.replace(LEGACY_FILE_PATH, LEGACY_FILE_PATH + ".migrated")
+    logger.info("Migrated %s into %s.", LEGACY_FILE_PATH, FILE_PATH)
@@ -1,215 +1,399 @@
 """Contains the main code for the Doorbell Slack bot."""
 
 import datetime as dt
+import logging
+import os
 import re
 import subprocess
 import sys
-from pathlib import Path
-from threading import Thread
-from time import sleep
-from typing import Final, Optional
+import urllib.request
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from threading import BoundedSemaphore, Event, Thread, Timer
+from typing import Callable, Final, Optional
 
 from pygame import mixer
 from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
 from slack_bolt.context.say import Say
 from slack_sdk import WebClient
-from websockets.exceptions import ConnectionClosed
-from websockets.sync import server
 
+import backup
 import database
+import log
+import metrics
+import reloader
+from audio import AudioPlayer
 from event_poller import EventPoller
 from google_calendar import GoogleCalendar
+from lazy import Lazy, WarmingUp
+from message_queue import MessageQueue
 from secret import APP_TOKEN, BOT_TOKEN, SOUND_PATH
+from slack_directory import SlackDirectory
 from slash_commands.roles_command import RolesCommand
-from tts import TTS
+from spotify_hub import SpotifyError, SpotifyHub
+from tts import TTS, create_tts
 
-mixer.init()
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Invocation:
+    """Someone mentioning Doorbell with a command."""
+
+    say: Say
+    channel_id: str
+    user: str
+    user_name: str
+    args: list[str]  # Lowercase, starting with the command
+    case_sensitive_args: list[str]  # Needed for URLs
+
+
+@dataclass(frozen=True)
+class Command:
+    """What a command runs and how. Fast commands run right away on the thread Slack's event came in on,
+    slow ones are run by a small pool of threads so that they never hold up a doorbell ring."""
+
+    run: Callable[["Doorbell", Invocation], None]
+    slow: bool = False
+    timeout_seconds: float = 60  # How long a slow command runs before the channel is told it's still going
 
 
 class Doorbell:
     """The Doorbell Slack bot. All of the functionality starts in mention_event()."""
 
-    app = App(token=BOT_TOKEN)
-    slack_socket_handler = SocketModeHandler(app, APP_TOKEN)
-    DOORBELL_WORDS: Final = ["door", "noor", "abracadabra", "open sesame", "ding", "ring", "boop"]
-    sound = mixer.Sound(SOUND_PATH)
-    calendar = GoogleCalendar()
-    text_to_speech = TTS()
-    spicetify_client_connection: Optional[server.ServerConnection] = None
-
-    def __init__(self) -> None:
-        if "-l" in sys.argv:
-            log_dir: Final = "./logs/"
-            Path(log_dir).mkdir(exist_ok=True)
-            sys.stderr = sys.stdout = open(
-                log_dir + dt.datetime.now().strftime("%Y-%m-%d--%H-%M-%S") + ".log", "w", encoding="utf-8", buffering=1
-            )
-        self.app.event("app_mention")(self.mention_event)
-        self.app.event("message")(self.message_event)
-        RolesCommand().register(self.app)
-        database.create()
-        database.check_for_corruption()
-        self._connect_to_slack()
-        self.event_poller = EventPoller(5, self)
-        self.event_poller.start()
-        self.websocket_server = server.serve(self._on_client_connection, "localhost", 8765)
-        Thread(target=self.websocket_server.serve_forever, name="Websocket Server").start()
+    DOORBELL_WORDS: Final = ["door", "noor", "abracadabra", "ding", "ring", "boop"]
+    SLOW_COMMAND_WORKERS: Final = 2
+    MAX_SLOW_COMMANDS: Final = 8  # Running and waiting, any more are turned away
+    SETUP_METHODS: Final = ("__init__", "_start")  # Hot reloading swaps methods but never calls these again
+    UPDATE_STEP_TIMEOUT_SECONDS: Final = 5 * 60
+    UPLOAD_TIMEOUT_SECONDS: Final = 5 * 60
+    TIME_WINDOW: Final = re.compile("^([0-1][0-9]|[2][0-3]):[0-5][0-9]-([0-1][0-9]|[2][0-3]):[0-5][0-9]$")
+    SPOTIFY_URL: Final = re.compile(r"^https://open\.spotify\.com/(intl-[\w-]+/)?(track|album|playlist)/\w+")
+    GROUP_ROLE_PINGS: Final = False  # Send role pings as multi-person DMs instead of a DM to each user
+
+    def __init__(
+        self,
+        client: Optional[WebClient] = None,
+        calendar: Optional[GoogleCalendar] = None,
+        text_to_speech: Optional[TTS] = None,
+    ) -> None:
+        """Slack, Google Calendar and text to speech are normally set up from secret.py but
+        can be passed in instead, e.g. to run Doorbell against local stand-ins.
+        Google Calendar and audio are started in the background, see wait_until_ready()."""
+        log.setup(to_file="-l" in sys.argv)
+        reloader.watch()
         self.closed = False
         self.restarting = False
+        self._closed_event = Event()
+        self.client = client or metrics.TimedWebClient(token=BOT_TOKEN)
+        self._calendar = Lazy("Google Calendar", lambda: calendar or GoogleCalendar()).start()
+        self._audio_player = Lazy("Audio", lambda: self._start_audio(text_to_speech)).start()
+        self.outbox = MessageQueue(self.client)
+        self.directory = SlackDirectory(self.client)
+        database.create()
+        database.check_for_corruption(restore=backup.restore)
+        self.event_poller = EventPoller(self)
+        self.spotify = SpotifyHub()
+        self.backups = backup.Scheduler()
+        self._command_pool = ThreadPoolExecutor(self.SLOW_COMMAND_WORKERS, thread_name_prefix="Command")
+        self._command_slots = BoundedSemaphore(self.MAX_SLOW_COMMANDS)
+        self._start()
+
+    @property
+    def calendar(self) -> GoogleCalendar:
+        """Google Calendar, raises WarmingUp until it has signed in and found the calendars."""
+        return self._calendar.get()
+
+    @property
+    def audio_player(self) -> AudioPlayer:
+        """Plays the chime and announcements, raises WarmingUp until the mixer and text to speech are ready."""
+        return self._audio_player.get()
+
+    def wait_until_ready(self, timeout: Optional[float] = None) -> None:
+        """Blocks until every subsystem started in the background is ready."""
+        self._calendar.wait(timeout)
+        self._audio_player.wait(timeout)
+
+    def _start_audio(self, text_to_speech: Optional[TTS]) -> AudioPlayer:
+        mixer.init()
+        audio_player = AudioPlayer(mixer.Sound(SOUND_PATH), text_to_speech or create_tts())
+        audio_player.start()
+        return audio_player
+
+    def _start(self) -> None:
+        """Connects to Slack and starts all of the background threads."""
+        self.app = self._create_app()
+        self.slack_socket_handler = SocketModeHandler(self.app, APP_TOKEN)
+        self._connect_to_slack()
+        Thread(target=self.directory.warm, name="Slack Directory", daemon=True).start()
+        self._calendar.when_ready(lambda _: self.event_poller.start())  # The poller can't do anything without it
+        self.metrics_server = metrics.start_server()
+        self.spotify.start()
+        self.backups.start()
+
+    def _create_app(self) -> App:
+        app = App(client=self.client)
+        self.register_listeners(app)
+        return app
+
+    def register_listeners(self, app: App) -> None:
+        """Registers all of Doorbell's Slack listeners with the app."""
+        app.event("app_mention")(self.mention_event)
+        app.event("message")(self.message_event)
+        RolesCommand().register(app)
+        self.directory.register(app)
+
+    def run(self) -> None:
+        """Blocks until Doorbell is closed."""
+        while not self._closed_event.wait(1):  # Waiting in intervals keeps Ctrl+C working on Windows
+            pass
 
     def mention_event(self, body: dict, say: Say) -> None:
         """The callback function for the Slack mention event, https://api.slack.com/events/app_mention."""
         event = body["event"]
-        channel_id = event["channel"]
         text: str = event["text"]
-        user = event["user"]
-        user_name = self.app.client.users_info(user=user)["user"]["real_name"]  # type: ignore
         args = text.lower().split()[1:]  # Ignore first word which is the mention
-        case_sensitive_args = text.split()[1:]  # Needed for URLs
-        print(f"Channel: {channel_id}/{self.get_channel_name(channel_id)}, Args: {args}, User: {user_name}")
-
         if len(args) < 1:
             say("Hi! (Try using 'help' to get a list of commands).")
             return
-        cmd = args[0]
+        user = event["user"]
+        invocation = Invocation(say, event["channel"], user, self.directory.user_name(user), args, text.split()[1:])
+        command = self.COMMANDS.get(args[0], self.COMMANDS["help"])
+        if not command.slow:
+            self._run_command(command, invocation)
+            return
+        if not self._command_slots.acquire(blocking=False):  # pylint: disable=consider-using-with
+            say("Doorbell is busy with other commands, try again in a bit.")
+            return
+        say("Working on it…")
+        future = self._command_pool.submit(self._run_command, command, invocation)
+        future.add_done_callback(self._slow_command_done)
+        reminder = Timer(command.timeout_seconds, self._warn_if_running, (future, invocation))
+        reminder.daemon = True
+        reminder.start()
+
+    def _run_command(self, command: "Command", invocation: "Invocation") -> None:
+        label = self._command_label(invocation.args[0])
+        message = f"{invocation.user_name} ran {invocation.args} in #{self.get_channel_name(invocation.channel_id)}"
+        logged = log.timed(logger, message, channel=invocation.channel_id, user=invocation.user, command=label)
+        try:
+            with metrics.timed("command", command=label), logged:
+                command.run(self, invocation)
+        except WarmingUp as warming_up:
+            invocation.say(f"{warming_up} is still warming up, try again in a few seconds.")
+
+    def _slow_command_done(self, future: Future[None]) -> None:
+        self._command_slots.release()
+        if not future.cancelled() and future.exception() is not None:
+            logger.error("Command failed.", exc_info=future.exception())
+
+    def _warn_if_running(self, future: Future[None], invocation: "Invocation") -> None:
+        if not future.done():
+            invocation.say(f"`{invocation.args[0]}` is taking longer than expected, it's still running.")
+
+    def _command_label(self, cmd: str) -> str:
+        """Returns the name a command's metrics are recorded under, invalid commands are lumped together."""
         if cmd in self.DOORBELL_WORDS:
-            self.ring_doorbell(say, user_name, args)
-        elif cmd == "schedule":
-            self.manage_schedule(say, args)
-        elif cmd == "calendars":
-            say("Calendars: " + ", ".join(list(self.calendar.calendars)))
-        elif cmd == "next":
-            if len(case_sensitive_args) < 2:
-                say("Need to provide a calendar.")
-                return
-            calendar_name = " ".join(case_sensitive_args[1:])
-            if calendar_name not in self.calendar.calendars:
-                say(f"Invalid calendar '{calendar_name}'.")
-                return
-            event = self.calendar.get_next_event(calendar_name)
-            if event is None:
-                say(f"{calendar_name} has no future events.")
-                return
-            say(f"{event.name} - {event.start.strftime(GoogleCalendar.DATE_FORMAT)}")
-        elif cmd == "subscribe":
-            self.calendar_subscribe(say, channel_id, case_sensitive_args)
-        elif cmd == "unsubscribe":
-            if len(case_sensitive_args) < 2:
-                say("Must provide a calendar to unsubscribe from.")
-            calendar_name = " ".join(case_sensitive_args[1:])
-            data = database.read()
-            subs = data.subscriptions_for_channel(channel_id)
-            for sub in subs:
-                if sub.calendar_name == calendar_name:
-                    data.subscriptions.remove(sub)
-                    database.write(data)
-                    say(f"Unsubscribed from {calendar_name}.")
-                    break
-            else:
-                say("No subscription to that calendar.")
-        elif cmd == "subscriptions":
-            say(database.read().subscriptions_to_str(channel_id))
-        elif cmd == "all_subscriptions":
-            say(database.read().all_subscriptions_to_str(self))
-        elif cmd == "play":
-            self.play_song(say, case_sensitive_args)
-        elif cmd == "restart":
-            self.restart(say)
-        elif cmd == "update":
-            say("Updating.")
-            result = subprocess.run("git pull", capture_output=True, text=True, check=False)
-            subprocess.run([sys.executable, "-m", "pip", "install", "-r", "requirements.txt"], check=False)
-            subprocess.run(["npm.cmd", "run", "build"], check=False, cwd="spicetify-extension/")
-            subprocess.run(["spicetify", "backup", "apply"], check=False)
-            subprocess.run(["spicetify", "apply"], check=False)
-            say(f"{result.stdout.strip()} {result.stderr.strip()}", unfurl_links=False, unfurl_media=False)
-            self.restart(say)
-        elif cmd == "backup":
-            say("Here ya go boss.")
-            self.upload_file(channel_id, bytes(database.get_copy()), database.FILE_PATH)
-        elif cmd == "version":
-            result = subprocess.run("git rev-parse HEAD", capture_output=True, text=True, check=False)
-            say(f"Doorbell is currently on commit {result.stdout.strip()}.")
-        elif cmd in ("exit", "stop"):
-            say("Stopping.")
-            self.close()
+            return "door"
+        return cmd if cmd in self.COMMANDS else "invalid"
+
+    def _door_command(self, c: "Invocation") -> None:
+        self.ring_doorbell(c.say, c.user_name, c.args)
+
+    def _schedule_command(self, c: "Invocation") -> None:
+        self.manage_schedule(c.say, c.args)
+
+    def _calendars_command(self, c: "Invocation") -> None:
+        c.say("Calendars: " + ", ".join(list(self.calendar.calendars)))
+
+    def _next_command(self, c: "Invocation") -> None:
+        if len(c.case_sensitive_args) < 2:
+            c.say("Need to provide a calendar.")
+            return
+        calendar_name = " ".join(c.case_sensitive_args[1:])
+        if calendar_name not in self.calendar.calendars:
+            c.say(f"Invalid calendar '{calendar_name}'.")
+            return
+        event = self.calendar.get_next_event(calendar_name)
+        if event is None:
+            c.say(f"{calendar_name} has no future events.")
+            return
+        c.say(f"{event.name} - {event.start.strftime(GoogleCalendar.DATE_FORMAT)}")
+
+    def _subscribe_command(self, c: "Invocation") -> None:
+        self.calendar_subscribe(c.say, c.channel_id, c.case_sensitive_args)
+
+    def _unsubscribe_command(self, c: "Invocation") -> None:
+        if len(c.case_sensitive_args) < 2:
+            c.say("Must provide a calendar to unsubscribe from.")
+        calendar_name = " ".join(c.case_sensitive_args[1:])
+        if database.remove_subscription(c.channel_id, calendar_name):
+            self.event_poller.wake()
+            c.say(f"Unsubscribed from {calendar_name}.")
         else:
-            invalid = "" if cmd == "help" else f"Invalid argument: {cmd}. "
-            say(
-                f"{invalid}Valid arguments are door, schedule, calendars, next, subscribe,"
-                " unsubscribe, subscriptions, all_subscriptions, play, restart, update, backup, version, and exit."
-            )
+            c.say("No subscription to that calendar.")
+
+    def _subscriptions_command(self, c: "Invocation") -> None:
+        c.say(database.read().subscriptions_to_str(c.channel_id))
 
-    def message_event(self, body: dict, client: WebClient) -> None:
+    def _all_subscriptions_command(self, c: "Invocation") -> None:
+        c.say(database.read().all_subscriptions_to_str(self))
+
+    def _play_command(self, c: "Invocation") -> None:
+        self.play_song(c.say, c.channel_id, c.case_sensitive_args)
+
+    def _restart_command(self, c: "Invocation") -> None:
+        self.restart(c.say, hard=len(c.args) > 1 and c.args[1] == "hard")
+
+    def _update_command(self, c: "Invocation") -> None:
+        c.say("Updating.")
+        timeout = self.UPDATE_STEP_TIMEOUT_SECONDS
+        try:
+            result = subprocess.run("git pull", capture_output=True, text=True, check=False, timeout=timeout)
+            for step, cwd in (
+                ([sys.executable, "-m", "pip", "install", "-r", "requirements.txt"], None),
+                (["npm.cmd", "run", "build"], "spicetify-extension/"),
+                (["spicetify", "backup", "apply"], None),
+                (["spicetify", "apply"], None),
+            ):
+                subprocess.run(step, check=False, cwd=cwd, timeout=timeout)
+        except subprocess.TimeoutExpired as error:
+            c.say(f"Update failed, `{error.cmd}` took longer than {timeout} seconds.")
+            return
+        c.say(f"{result.stdout.strip()} {result.stderr.strip()}", unfurl_links=False, unfurl_media=False)
+        self.restart(c.say)
+
+    def _backup_command(self, c: "Invocation") -> None:
+        path = backup.compressed_snapshot()
+        try:
+            c.say("Here ya go boss.")
+            self.upload_file(c.channel_id, path, database.FILE_PATH + ".gz")
+        finally:
+            os.remove(path)
+
+    def _stats_command(self, c: "Invocation") -> None:
+        c.say(f"```{metrics.summary()}```")
+
+    def _version_command(self, c: "Invocation") -> None:
+        result = subprocess.run("git rev-parse HEAD", capture_output=True, text=True, check=False)
+        c.say(f"Doorbell is currently on commit {result.stdout.strip()}.")
+
+    def _exit_command(self, c: "Invocation") -> None:
+        c.say("Stopping.")
+        self.close()
+
+    def _help_command(self, c: "Invocation") -> None:
+        invalid = "" if c.args[0] == "help" else f"Invalid argument: {c.args[0]}. "
+        c.say(
+            f"{invalid}Valid arguments are door, schedule, calendars, next, subscribe, unsubscribe,"
+            " subscriptions, all_subscriptions, play, restart, update, backup, stats, version, and exit."
+        )
+
+    COMMANDS: Final[dict[str, "Command"]] = {  # Name: Command, anything else gets help
+        **dict.fromkeys(DOORBELL_WORDS, Command(_door_command)),
+        "schedule": Command(_schedule_command),
+        "calendars": Command(_calendars_command),
+        "next": Command(_next_command),
+        "subscribe": Command(_subscribe_command),
+        "unsubscribe": Command(_unsubscribe_command),
+        "subscriptions": Command(_subscriptions_command),
+        "all_subscriptions": Command(_all_subscriptions_command),
+        "play": Command(_play_command),
+        "restart": Command(_restart_command),
+        "update": Command(_update_command, slow=True, timeout_seconds=10 * 60),
+        "backup": Command(_backup_command, slow=True),
+        "stats": Command(_stats_command),
+        "version": Command(_version_command, slow=True),
+        "exit": Command(_exit_command),
+        "stop": Command(_exit_command),
+        "help": Command(_help_command),
+    }
+
+    @metrics.timed("message_event")
+    def message_event(self, body: dict) -> None:
         """Triggers on every message event, listens for roles being pinged to send out dms."""
         event = body["event"]
         text: str = event.get("text", "")
-        data = database.read()
-        roles = data.get_roles()
-        users = set()
-        for role in roles:
-            if "@" + role.lower() in text.lower():
-                users.update(data.get_users_for_role(role))
-        sender = client.users_info(user=event["user"])["user"]["real_name"]  # type: ignore
-        link = client.chat_getPermalink(channel=event.get("channel", ""), message_ts=event.get("ts", "")).get(
-            "permalink", ""
-        )
+        users = database.read().get_users_for_mentions(text)
+        if not users:
+            return
+        sender = self.directory.user_name(event["user"])
+        link = self.directory.permalink(event.get("channel", ""), event.get("ts", ""), event.get("thread_ts"))
         text = f"{sender}:\n{text}\n<{link}|Link to message>"
-        for user in users:
-            self.post_message(user, text)
+        self.post_to_users(users, text)
 
     def ring_doorbell(self, say: Say, user: str, args: list[str]) -> None:
         """Rings the doorbell and activates text to speech if the schedule allows it."""
-        schedule = database.read().schedule
-        if not schedule:
+        data = database.read()
+        if not data.schedule:
             say("Schedule not created yet!")
             return
-        date = dt.datetime.now()
-        day = schedule[date.weekday()]
-        if day is not None and (day.start_time <= date.time() <= day.end_time):
-            say(f"Ding! ({user})")
-            self.sound.play()
-            sleep(self.sound.get_length())
-            door = "" if len(args) < 2 else args[1]
-            if not re.match(r"^\d{2}[a-z]$", door):
-                door = ""
-            self.text_to_speech.say(f"{user} is at the door {door}", blocking=True)
-        else:
+        if not data.is_open(dt.datetime.now()):
             say("Sorry, currently Doorbell isn't supposed to run. Check the schedule? @Doorbell schedule")
+            return
+        audio_player = self.audio_player
+        say(f"Ding! ({user})")
+        door = "" if len(args) < 2 else args[1]
+        if not re.match(r"^\d{2}[a-z]$", door):
+            door = ""
+        audio_player.announce(user, door)
 
     def manage_schedule(self, say: Say, args: list[str]) -> None:
-        """Either reads the current schedule to the user or accepts a new schedule to write from the user."""
-        data = database.read()
+        """Either reads the current schedule to the user, accepts a new weekly schedule or changes
+        the schedule of a specific date."""
         if len(args) < 2:
-            if not data.schedule:
-                say("Schedule not created yet!")
-            else:
-                say(data.schedule_to_str())
+            data = database.read()
+            say("Schedule not created yet!" if not data.schedule else data.schedule_to_str())
+        elif args[1] in ("on", "reset"):
+            self.override_schedule(say, args)
         elif len(args) < 8:
             say(
                 "Need to specify the times of each day that doorbell can run or use a `-` to not run that day."
-                + " It starts with Monday all the way till Sunday, e.g. 14:10-16:30 - - - - 12:00-13:00 -"
+                + " It starts with Monday all the way till Sunday, e.g. 14:10-16:30 - - - - 12:00-13:00,15:00-17:00 -"
+                + " To change a single date use `schedule on 2024-12-25 -` and `schedule reset 2024-12-25` to undo it."
             )
         else:
-            new_schedule: list[Optional[database.DaySchedule]] = []
-            active_times = args[1:]
-            for day in range(7):
-                time = active_times[day]
-                if time == "-":
-                    new_schedule.append(None)
-                elif re.match("^([0-1][0-9]|[2][0-3]):[0-5][0-9]-([0-1][0-9]|[2][0-3]):[0-5][0-9]$", time) is None:
-                    say("Invalid time format. Should be XX:XX-XX:XX in 24 hour time.")
+            new_schedule: list[list[database.DaySchedule]] = []
+            for times in args[1:8]:
+                windows = self._parse_windows(times)
+                if windows is None:
+                    say("Invalid time format. Should be XX:XX-XX:XX in 24 hour time, separated by commas.")
                     return
-                else:
-                    start, end = time.split("-")
-                    start_time = dt.time(int(start.split(":")[0]), int(start.split(":")[1]))
-                    end_time = dt.time(int(end.split(":")[0]), int(end.split(":")[1]))
-                    new_schedule.append(database.DaySchedule(start_time, end_time))
-            data.schedule = new_schedule
-            database.write(data)
+                new_schedule.append(windows)
+            database.set_schedule(new_schedule)
             say(f"Wrote schedule.\n{database.read().schedule_to_str()}")
 
+    def override_schedule(self, say: Say, args: list[str]) -> None:
+        """Changes or resets the schedule of a specific date, e.g. to close for a holiday."""
+        try:
+            day = dt.date.fromisoformat(args[2])
+        except (IndexError, ValueError):
+            say("Need to specify a date as YYYY-MM-DD.")
+            return
+        if args[1] == "reset":
+            database.set_schedule_override(day, None)
+            say(f"{day.isoformat()} follows the weekly schedule again.")
+            return
+        windows = None if len(args) < 4 else self._parse_windows(args[3])
+        if windows is None:
+            say("Invalid time format. Should be XX:XX-XX:XX in 24 hour time, separated by commas, or `-`.")
+            return
+        database.set_schedule_override(day, windows)
+        say(f"Wrote schedule.\n{database.read().schedule_to_str()}")
+
+    def _parse_windows(self, times: str) -> Optional[list[database.DaySchedule]]:
+        """Parses a day's times like 08:00-12:00,13:00-17:00 or - for none, returns None if they're invalid."""
+        if times == "-":
+            return []
+        windows = []
+        for window in times.split(","):
+            if self.TIME_WINDOW.match(window) is None:
+                return None
+            start, end = window.split("-")
+            windows.append(database.DaySchedule(dt.time.fromisoformat(start), dt.time.fromisoformat(end)))
+        return sorted(windows, key=lambda window: window.start_time)
+
     def calendar_subscribe(self, say: Say, channel: str, args: list[str]) -> None:
         """Subscribes to a google calendar to be reminded of any future events."""
         if len(args) < 2:
@@ -227,77 +411,132 @@ class Doorbell:
                 say(f"Invalid calendar '{calendar_name}'.")
                 return
             next_event = self.calendar.get_next_event(calendar_name)
-            data = database.read()
-            subs = data.subscriptions_for_channel(channel)
-            for sub in subs:
-                if sub.calendar_name == calendar_name:
-                    say("Can't subscribe to the same calendar multiple times in the same channel.")
-                    return
-            data.subscriptions.append(
-                database.Subscription(
-                    channel, calendar_name, remind_time, next_event, dt.datetime.now().astimezone(dt.timezone.utc)
-                )
+            subscription = database.Subscription(
+                channel, calendar_name, remind_time, next_event, dt.datetime.now().astimezone(dt.timezone.utc)
             )
-            database.write(data)
+            if not database.add_subscription(subscription):
+                say("Can't subscribe to the same calendar multiple times in the same channel.")
+                return
+            self.event_poller.wake()
             say(f"Subscribed to {calendar_name} and reminds {str(remind_time.total_seconds() / 3600)} hours before.")
 
-    def play_song(self, say: Say, args: list[str]) -> None:
-        """Adds a Spotify song to the queue if Spotify is open."""
-        if len(args) < 2:
-            say("Must give a Spotify track URL.")
+    def play_song(self, say: Say, channel_id: str, args: list[str]) -> None:
+        """Asks Spotify to add every track, album and playlist URL in the message to its queue in one request
+        without waiting for it, the channel is told once Spotify has added them. Songs played while Spotify
+        is disconnected are added when it reconnects."""
+        urls = [url.strip("<>").split("|")[0] for url in args[1:]]  # Links in slack are <url> or <url|text>
+        if not urls:
+            say("Must give Spotify track, album or playlist URLs.")
             return
-        if self.spicetify_client_connection is None:
-            say("Spotify has not connected to Doorbell.")
+        invalid = [url for url in urls if not self.SPOTIFY_URL.match(url)]
+        if invalid:
+            say(f"Invalid Spotify URL: {invalid[0]}")
             return
-        song_url = args[1].replace("<", "").replace(">", "")  # Links in slack are bound by angle brackets
-        if not re.match(r"^https://open.spotify.com/", song_url):
-            say("Invalid Spotify URL.")
+        if not self.spotify.connected:
+            say("Spotify has not connected to Doorbell, the songs will be added once it does.")
+        self.spotify.play(urls).add_done_callback(lambda future: self._on_songs_queued(future, channel_id, urls))
+
+    def _on_songs_queued(self, future: Future[int], channel_id: str, urls: list[str]) -> None:
+        requested = urls[0] if len(urls) == 1 else f"{len(urls)} links"
+        if future.cancelled():
             return
-        try:
-            self.spicetify_client_connection.send(song_url)
-        except ConnectionClosed:
-            self.spicetify_client_connection = None
-            say("Doorbell has lost connection with Spotify.")
+        error = future.exception()
+        if isinstance(error, SpotifyError):
+            self.post_message(channel_id, f"Couldn't add {requested} to the queue: {error}")
+        elif error is not None:
+            logger.error("Failed to queue %s", urls, exc_info=error)
         else:
-            say(f"Added {song_url} to the queue.", unfurl_links=False, unfurl_media=False)
-
-    def _on_client_connection(self, client: server.ServerConnection) -> None:
-        print("\nSpicetify has connected!")
-        self.spicetify_client_connection = client
-        while not self.closed:
-            pass
+            songs = "1 song" if future.result() == 1 else f"{future.result()} songs"
+            self.post_message(channel_id, f"Added {songs} from {requested} to the queue.")
 
     def _connect_to_slack(self) -> None:
         self.slack_socket_handler.connect()
 
     def get_channel_name(self, channel_id: str) -> str:
         """Returns the name of Slack channel given its channel id."""
-        result = self.app.client.conversations_info(channel=channel_id)
-        if result["channel"] is not None:
-            return result["channel"].get("name", "None")  # type: ignore
-        return "None"
+        return self.directory.channel_name(channel_id)
 
     def post_message(self, channel_id: str, message: str) -> None:
-        """Posts a message to the specified Slack channel."""
-        self.app.client.chat_postMessage(channel=channel_id, text=message, unfurl_links=False, unfurl_media=False)
-        print(f'Posted "{message}" to {channel_id}.')
-
-    def upload_file(self, channel_id: str, file: bytes, name: str) -> None:
-        """Uploads a file to the specified Slack channel."""
-        self.app.client.files_upload_v2(channel=channel_id, file=file, filename=name)
-        print(f"Uploaded {name} to {channel_id}.")
-
-    def restart(self, say: Say) -> None:
-        """Sets a flag for consumers that Doorbell should be restarted. All restart logic is
-        handled externally.
-        """
+        """Queues a message to be posted to the specified Slack channel."""
+        self.outbox.post_message(channel_id, message)
+
+    def post_to_users(self, users: set[str], message: str) -> None:
+        """Queues a direct message to each of the users."""
+        if self.GROUP_ROLE_PINGS:
+            self.outbox.post_group_message(users, message)
+            return
+        for user in users:
+            self.post_message(user, message)
+
+    def upload_file(self, channel_id: str, path: str, name: str) -> None:
+        """Uploads a file to the specified Slack channel, streaming it from the disk instead of reading it
+        all into memory. It's the same external upload files_upload_v2 does."""
+        size = os.path.getsize(path)
+        upload = self.client.files_getUploadURLExternal(filename=name, length=size)
+        with open(path, "rb") as file, metrics.timed("slack_api", method="files.upload"):
+            request = urllib.request.Request(upload["upload_url"], data=file, method="POST")
+            request.add_header("Content-Length", str(size))
+            with urllib.request.urlopen(request, timeout=self.UPLOAD_TIMEOUT_SECONDS):
+                pass
+        self.client.files_completeUploadExternal(
+            files=[{"id": upload["file_id"], "title": name}], channel_id=channel_id
+        )
+        logger.info("Uploaded %s to %s.", name, channel_id)
+
+    def restart(self, say: Say, hard: bool = False) -> None:
+        """Hot reloads Doorbell if only reloadable modules have changed, otherwise sets a flag for
+        consumers that Doorbell should be restarted. All restart logic is then handled externally."""
         say("Restarting.")
+        changed = reloader.changed_modules()
+        if not hard and reloader.can_reload(changed) and self.hot_reload(changed):
+            say(f"Reloaded {', '.join(changed)}.")
+            return
         self.restarting = True
         self.close()
 
+    def hot_reload(self, changed: list[str]) -> bool:
+        """Re-imports the changed modules and switches Doorbell over to them without disconnecting from Slack
+        or dropping any caches. Slack events keep going to the old listeners until the new ones are swapped in
+        all at once. Only methods are swapped, Doorbell isn't constructed again, so changes to SETUP_METHODS
+        can't be hot reloaded. Returns False if reloading failed, in which case Doorbell needs a full restart."""
+        previous_class = type(self)
+        try:
+            modules = reloader.reload(changed)
+            # Subclasses defined outside the reloaded modules, e.g. in tests, keep their class
+            new_class = getattr(modules.get(previous_class.__module__), previous_class.__name__, previous_class)
+            setup_changed = [
+                name
+                for name in self.SETUP_METHODS
+                if not reloader.same_code(getattr(previous_class, name), getattr(new_class, name))
+            ]
+            if setup_changed:
+                logger.info("%s changed, restarting instead of hot reloading.", ", ".join(setup_changed))
+                return False
+            self.__class__ = new_class
+            app = self._create_app()
+        except Exception:  # pylint: disable=broad-exception-caught
+            logger.exception("Couldn't hot reload %s, restarting instead.", changed)
+            self.__class__ = previous_class
+            return False
+        self._swap_app(app)
+        logger.info("Hot reloaded %s.", changed)
+        return True
+
+    def _swap_app(self, app: App) -> None:
+        self.app = app
+        self.slack_socket_handler.app = app  # The handler looks up its app for every event
+
     def close(self) -> None:
         """Disconnects from Slack and kills all threads pertaining to Doorbell."""
         self.closed = True
         self.slack_socket_handler.close()
-        self.websocket_server.shutdown()
+        self.spotify.stop()
+        self.backups.stop()
+        self._command_pool.shutdown(wait=False, cancel_futures=True)
+        self.metrics_server.shutdown()
+        self.metrics_server.server_close()  # Frees the port for a restart right away
         self.event_poller.stop()
+        self._audio_player.when_ready(AudioPlayer.stop)
+        self.outbox.close()
+        database.close()
+        self._closed_event.set()
@@ -0,0 +1,60 @@
+"""Contains the offline text to speech backend that works anywhere espeak-ng is installed."""
+
+import io
+import subprocess
+import wave
+from time import monotonic, sleep
+from typing import Final
+
+from pygame import mixer
+
+from tts import TTS
+
+
+class ESpeakTTS(TTS[mixer.Sound]):
+    """Offline text to speech through the espeak-ng command line program. Speech is rendered
+    to an in-memory WAV and played through pygame's mixer, which needs to be initialized first."""
+
+    COMMAND: Final = "espeak-ng"
+    CHUNK_SECONDS: Final = 0.25  # How much audio is buffered at a time while streaming
+
+    def synthesize(self, text: str) -> mixer.Sound:
+        """Synthesizes a string of text into speech that can be played any number of times with play()."""
+        wav = subprocess.run([self.COMMAND, "--stdout", text], capture_output=True, check=True).stdout
+        return mixer.Sound(file=io.BytesIO(wav))
+
+    def stream(self, text: str) -> None:
+        """Says a string of text, starting playback as soon as espeak-ng has produced the first chunk of audio."""
+        start = monotonic()
+        channel = None
+        with subprocess.Popen([self.COMMAND, "--stdout", text], stdout=subprocess.PIPE) as process:
+            assert process.stdout is not None
+            with wave.open(process.stdout, "rb") as wav:
+                chunk_frames = int(wav.getframerate() * self.CHUNK_SECONDS)
+                while frames := wav.readframes(chunk_frames):
+                    sound = self._to_sound(wav, frames)
+                    if channel is None:
+                        channel = sound.play()
+                        self._first_audio(start)
+                        continue
+                    while channel.get_queue() is not None:  # A channel can only have one sound waiting
+                        sleep(0.01)
+                    channel.queue(sound)
+        while channel is not None and channel.get_busy():
+            sleep(0.01)
+
+    def _play(self, speech: mixer.Sound, blocking: bool, start: float) -> None:
+        speech.play()
+        self._first_audio(start)
+        if blocking:
+            sleep(speech.get_length())
+
+    def _to_sound(self, source: wave.Wave_read, frames: bytes) -> mixer.Sound:
+        buffer = io.BytesIO()
+        with wave.Wave_write(buffer) as wav:
+            wav.setnchannels(source.getnchannels())
+            wav.setsampwidth(source.getsampwidth())
+            wav.setframerate(source.getframerate())
+            wav.writeframes(frames)
+        buffer.seek(0)
+        return mixer.Sound(file=buffer)
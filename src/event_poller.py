@@ -1,58 +1,149 @@
-"""Contains the Event Poller which polls for any subscriptions and sends reminders."""
+"""Contains the Event Poller which sends reminders for any subscriptions when they're due."""
 
 from __future__ import annotations
 
+import asyncio
 import datetime as dt
-import time
+import heapq
+import itertools
+import logging
 from datetime import datetime
-from threading import Thread
-from typing import TYPE_CHECKING
+from threading import Condition, Thread
+from typing import TYPE_CHECKING, Callable, Optional
 
 import database
-from google_calendar import GoogleCalendar
+from google_calendar import CalendarEvent, GoogleCalendar
 
 if TYPE_CHECKING:
     from doorbell import Doorbell
 
+logger = logging.getLogger(__name__)
+
 
 class EventPoller(Thread):
-    """Used to poll any subscriptions and send appropriate reminders."""
+    """Sends subscription reminders at the time they're due. The thread sleeps until the earliest reminder
+    and is woken early through wake() whenever subscriptions are added or removed. Subscriptions without
+    a next event are checked for newly added calendar events every refresh_seconds."""
 
-    def __init__(self, interval_seconds: float, doorbell: Doorbell) -> None:
+    def __init__(self, doorbell: Doorbell, refresh_seconds: float = 60) -> None:
         super().__init__(target=self._continuously_poll, name="Event Poller")
-        self.interval_seconds = interval_seconds
         self.doorbell = doorbell
+        self.refresh_seconds = refresh_seconds
         self.stopped = False
+        self._condition = Condition()
+        self._changed = True
+        self._reminders: list[tuple[datetime, int, database.Subscription]] = []  # Heap ordered by reminder time
+        self._waiting: list[database.Subscription] = []  # Subscriptions without a next event
+        self._next_refresh = self._now()
+        self._counter = itertools.count()  # Tie breaker so subscriptions never get compared
+        self._notify_async: Optional[Callable[[], object]] = None
 
     def stop(self) -> None:
         """Stops this thread."""
-        self.stopped = True
+        with self._condition:
+            self.stopped = True
+            self._condition.notify()
+        if self._notify_async is not None:
+            self._notify_async()
+
+    def wake(self) -> None:
+        """Tells this thread that subscriptions have changed so that it reschedules its reminders."""
+        with self._condition:
+            self._changed = True
+            self._condition.notify()
+        if self._notify_async is not None:
+            self._notify_async()
+
+    async def run_async(self) -> None:
+        """Runs the poller as a task on the running event loop instead of starting this thread.
+        Stop it by cancelling the task."""
+        loop = asyncio.get_running_loop()
+        woken = asyncio.Event()
+        self._notify_async = lambda: loop.call_soon_threadsafe(woken.set)
+        while not self.stopped:
+            woken.clear()
+            await asyncio.to_thread(self._poll)
+            try:
+                await asyncio.wait_for(woken.wait(), self._seconds_until_next_wakeup())
+            except TimeoutError:
+                pass
+        logger.info("Stopped Event Poller.")
 
     def _continuously_poll(self) -> None:
         while not self.stopped:
-            self._poll_subscriptions()
-            time.sleep(self.interval_seconds)
-        print("Stopped Event Poller.")
-
-    def _poll_subscriptions(self) -> None:
-        data = database.read()
-        for sub in data.subscriptions:
-            current_date = datetime.now().astimezone(dt.timezone.utc)
-            if sub.next_event is None:  # Check if a new event has been added
-                min_date = max(current_date, sub.last_event)
-                next_event = self.doorbell.calendar.get_next_event(sub.calendar_name, min_date)
-                sub.next_event = next_event
+            self._poll()
+            with self._condition:
+                if not self.stopped and not self._changed:
+                    self._condition.wait(self._seconds_until_next_wakeup())
+        logger.info("Stopped Event Poller.")
+
+    def _poll(self) -> None:
+        with self._condition:
+            if self._changed:
+                self._changed = False
+                self._rebuild()
+        self._check_for_new_events()
+        self._send_due_reminders()
+
+    def _rebuild(self) -> None:
+        self._reminders.clear()
+        self._waiting.clear()
+        for sub in list(database.read().subscriptions.values()):
+            self._schedule(sub)
+
+    def _schedule(self, sub: database.Subscription) -> None:
+        if sub.next_event is None:
+            self._waiting.append(sub)
+        else:
+            remind_at = (sub.next_event.start - sub.remind_time).astimezone(dt.timezone.utc)
+            heapq.heappush(self._reminders, (remind_at, next(self._counter), sub))
+
+    def _seconds_until_next_wakeup(self) -> float:
+        wakeup = self._next_refresh if self._waiting else None
+        if self._reminders and (wakeup is None or self._reminders[0][0] < wakeup):
+            wakeup = self._reminders[0][0]
+        if wakeup is None:
+            return self.refresh_seconds
+        return max((wakeup - self._now()).total_seconds(), 0)
+
+    def _check_for_new_events(self) -> None:
+        current_date = self._now()
+        if not self._waiting or current_date < self._next_refresh:
+            return
+        self._next_refresh = current_date + dt.timedelta(seconds=self.refresh_seconds)
+        waiting = self._waiting
+        self._waiting = []
+        self.doorbell.calendar.sync_all(sub.calendar_name for sub in waiting)  # Once per calendar, not per sub
+        for sub in waiting:
+            min_date = max(current_date, sub.last_event)
+            sub.next_event = self.doorbell.calendar.get_next_event(sub.calendar_name, min_date)
+            if sub.next_event is not None:
+                database.update_subscription(sub)
+            self._schedule(sub)
+
+    def _send_due_reminders(self) -> None:
+        current_date = self._now()
+        sent: list[tuple[database.Subscription, CalendarEvent]] = []
+        while self._reminders and self._reminders[0][0] <= current_date:
+            _, _, sub = heapq.heappop(self._reminders)
+            event = sub.next_event
+            # Skips subscriptions that have been removed or replaced since they were scheduled
+            if event is None or database.read().get_subscription(sub.channel_id, sub.calendar_name) is not sub:
                 continue
-            name = sub.next_event.name
-            remind_window_start = sub.next_event.start - sub.remind_time
-            if current_date >= remind_window_start.astimezone(dt.timezone.utc):
-                self.doorbell.post_message(
-                    channel_id=sub.channel_id,
-                    message=f"Reminder: {name} - {sub.next_event.start.strftime(GoogleCalendar.DATE_FORMAT)}",
-                )
-                event_end = sub.next_event.end
-                min_date = max(current_date, event_end)
-                next_event = self.doorbell.calendar.get_next_event(sub.calendar_name, min_date)
-                sub.next_event = next_event
-                sub.last_event = event_end
-        database.write(data)
+            self.doorbell.post_message(
+                channel_id=sub.channel_id,
+                message=f"Reminder: {event.name} - {event.start.strftime(GoogleCalendar.DATE_FORMAT)}",
+            )
+            sent.append((sub, event))
+        if not sent:
+            return
+        self.doorbell.calendar.sync_all(sub.calendar_name for sub, _ in sent)  # Once per calendar, not per sub
+        for sub, event in sent:
+            min_date = max(current_date, event.end)
+            sub.next_event = self.doorbell.calendar.get_next_event(sub.calendar_name, min_date)
+            sub.last_event = event.end
+            database.update_subscription(sub)
+            self._schedule(sub)
+
+    def _now(self) -> datetime:
+        return datetime.now().astimezone(dt.timezone.utc)
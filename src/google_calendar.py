@@ -1,16 +1,47 @@
-"""Contains the GoogleCalendar class for accessing the team's calendar."""
+"""Contains the GoogleCalendar class for accessing the team's calendar.
+Events are cached locally per calendar and kept up to date with incremental syncs."""
+
+from __future__ import annotations
 
 import datetime as dt
+import logging
 import os.path
+from bisect import bisect_left
+from contextlib import ExitStack
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Final, Optional
+from math import inf
+from threading import Lock, Thread
+from time import monotonic
+from typing import Final, Iterable, Optional, TypedDict
 
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from googleapiclient.discovery import Resource, build
 from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class _EventTime(TypedDict, total=False):
+    """When an event starts or ends in the Google Calendar API, dateTime for timed events and date for all day ones."""
+
+    date: str
+    dateTime: str
+
+
+class _Event(TypedDict, total=False):
+    """An event from the Google Calendar API, only the fields Doorbell uses."""
+
+    id: str
+    status: str
+    summary: str
+    start: _EventTime
+    end: _EventTime
 
 
 @dataclass(frozen=True)
@@ -27,23 +58,18 @@ class GoogleCalendar:
 
     SCOPES: Final = ["https://www.googleapis.com/auth/calendar.readonly"]
     DATE_FORMAT: Final[str] = "%#m/%d/%Y - %#I:%M %p"  # Only works on windows machines
+    MAX_CACHE_AGE_SECONDS: Final = 60  # Older caches are still used but get synced in the background
     calendars: dict[str, str] = {}  # Name: CalendarID
 
-    def __init__(self) -> None:
+    def __init__(self, service: Optional[Resource] = None) -> None:
+        """Signs into Google unless an already built Calendar API service is passed in."""
+        self._caches: dict[str, _CalendarCache] = {}  # Name: Cache
+        self._caches_lock = Lock()
+        self._service_lock = Lock()  # The Google API client isn't thread safe
         try:
-            creds = None
-            if os.path.exists("token.json"):
-                creds = Credentials.from_authorized_user_file("token.json", self.SCOPES)
-            if not creds or not creds.valid:
-                if creds and creds.expired and creds.refresh_token:
-                    creds.refresh(Request())
-                else:
-                    flow = InstalledAppFlow.from_client_secrets_file("credentials.json", self.SCOPES)
-                    creds = flow.run_local_server(port=0)
-                with open("token.json", "w", encoding="utf-8") as token:
-                    token.write(creds.to_json())
-            self.service = build("calendar", "v3", credentials=creds)
-            result = self.service.calendarList().list().execute()
+            self.service = service or self._build_service()
+            with metrics.timed("calendar_api", method="calendarList.list"):
+                result = self.service.calendarList().list().execute()
             calendar_list: list[dict] = result.get("items", [])
             if calendar_list:
                 for calendar in calendar_list:
@@ -51,44 +77,191 @@ class GoogleCalendar:
                     calendar_id = calendar.get("id", "")
                     self.calendars.update({name: calendar_id})
         except HttpError as error:
-            print(f"GoogleCalendar Error: {error}")
+            logger.error("GoogleCalendar Error: %s", error)
+
+    def _build_service(self) -> Resource:
+        creds = None
+        if os.path.exists("token.json"):
+            creds = Credentials.from_authorized_user_file("token.json", self.SCOPES)
+        if not creds or not creds.valid:
+            if creds and creds.expired and creds.refresh_token:
+                creds.refresh(Request())
+            else:
+                flow = InstalledAppFlow.from_client_secrets_file("credentials.json", self.SCOPES)
+                creds = flow.run_local_server(port=0)
+            with open("token.json", "w", encoding="utf-8") as token:
+                token.write(creds.to_json())
+        return build("calendar", "v3", credentials=creds)
 
     def get_events(self, calendar: str, min_date: Optional[datetime] = None) -> list[CalendarEvent]:
-        """Returns list of events for the given calendar
-        in the form of a tuple with the event's name, start date, and end date."""
-        events: list[CalendarEvent] = []
+        """Returns the list of events for the given calendar that start at or after min_date (defaults to now),
+        ordered by start date. Events are served from a local cache of the calendar."""
+        cache = self._get_cache(calendar)
+        if cache is None:
+            return []
+        starts, events = cache.index
+        return events[bisect_left(starts, self._min_date(min_date)) :]
+
+    def get_next_event(self, calendar: str, min_date: Optional[datetime] = None) -> Optional[CalendarEvent]:
+        """Returns the first event for the given calendar that starts at or after min_date (defaults to now)
+        or None if there is no next event."""
+        cache = self._get_cache(calendar)
+        if cache is None:
+            return None
+        starts, events = cache.index
+        i = bisect_left(starts, self._min_date(min_date))
+        return events[i] if i < len(events) else None
+
+    def sync(self, calendar: str) -> None:
+        """Brings the local cache of a calendar up to date, only fetching what changed since the last sync."""
         calendar_id = self.calendars.get(calendar)
         if calendar_id is None:
-            return events
+            return
+        cache = self._cache_for(calendar)
+        with cache.lock:
+            self._sync_locked(calendar_id, cache)
+
+    def sync_all(self, calendars: Iterable[str]) -> None:
+        """Brings the caches of several calendars up to date at once, skipping any that were synced within
+        MAX_CACHE_AGE_SECONDS. When more than one needs syncing they're all fetched in a single batch request."""
+        stale = sorted({calendar for calendar in calendars if calendar in self.calendars and self._is_stale(calendar)})
+        if len(stale) < 2:
+            for calendar in stale:
+                self.sync(calendar)
+            return
+        responses: dict[str, tuple[Optional[dict], Optional[HttpError]]] = {}  # Name: (Response, Error)
+
+        def on_response(calendar: str, response: Optional[dict], error: Optional[HttpError]) -> None:
+            responses[calendar] = (response, error)
+
+        with ExitStack() as locks:
+            batch = self.service.new_batch_http_request(callback=on_response)
+            for calendar in stale:  # Sorted so that concurrent batches take the cache locks in the same order
+                cache = self._cache_for(calendar)
+                locks.enter_context(cache.lock)
+                batch.add(self._list_request(self.calendars[calendar], cache.sync_token, None), request_id=calendar)
+            try:
+                with self._service_lock, metrics.timed("calendar_api", method="batch"):
+                    batch.execute()
+            except HttpError as error:
+                logger.error("GoogleCalendar Error: %s", error)
+                return
+            for calendar, (response, sync_error) in responses.items():
+                calendar_id, cache = self.calendars[calendar], self._caches[calendar]
+                if sync_error is not None or response is None:  # Retried on its own, which also handles expired tokens
+                    self._sync_locked(calendar_id, cache)
+                    continue
+                items, sync_token = response.get("items", []), response.get("nextSyncToken")
+                if response.get("nextPageToken") is not None:
+                    with self._service_lock:
+                        more, sync_token = self._list_changes(calendar_id, cache.sync_token, response["nextPageToken"])
+                    items += more
+                cache.apply(items, sync_token)
+
+    def _cache_for(self, calendar: str) -> _CalendarCache:
+        with self._caches_lock:
+            return self._caches.setdefault(calendar, _CalendarCache())
+
+    def _is_stale(self, calendar: str) -> bool:
+        cache = self._caches.get(calendar)
+        return cache is None or cache.sync_token is None or monotonic() - cache.synced_at > self.MAX_CACHE_AGE_SECONDS
+
+    def _sync_locked(self, calendar_id: str, cache: _CalendarCache) -> None:
+        """Syncs a cache whose lock is already held."""
+        try:
+            with self._service_lock:
+                items, sync_token = self._list_changes(calendar_id, cache.sync_token)
+        except HttpError as error:
+            if error.resp.status != 410:  # 410 means the sync token expired and a full sync is needed
+                logger.error("GoogleCalendar Error: %s", error)
+                return
+            cache.clear()
+            with self._service_lock:
+                items, sync_token = self._list_changes(calendar_id, None)
+        cache.apply(items, sync_token)
+
+    def _get_cache(self, calendar: str) -> Optional[_CalendarCache]:
+        """Returns the cache for a calendar, syncing it first if it's empty and in the background if it's stale."""
+        if calendar not in self.calendars:
+            return None
+        cache = self._caches.get(calendar)
+        if cache is None or cache.sync_token is None:
+            self.sync(calendar)
+            return self._caches.get(calendar)
+        if self._is_stale(calendar):
+            with self._caches_lock:
+                if cache.refreshing:
+                    return cache
+                cache.refreshing = True
+            Thread(target=self._background_sync, args=(calendar, cache), name="Calendar Sync", daemon=True).start()
+        return cache
+
+    def _background_sync(self, calendar: str, cache: _CalendarCache) -> None:
+        try:
+            self.sync(calendar)
+        finally:
+            cache.refreshing = False
+
+    def _list_changes(
+        self, calendar_id: str, sync_token: Optional[str], page_token: Optional[str] = None
+    ) -> tuple[list[_Event], Optional[str]]:
+        """Lists every event that changed since sync_token or all events if there is no sync token,
+        starting from page_token if given."""
+        items: list[_Event] = []
+        while True:
+            with metrics.timed("calendar_api", method="events.list"):
+                result = self._list_request(calendar_id, sync_token, page_token).execute()
+            items += result.get("items", [])
+            page_token = result.get("nextPageToken")
+            if page_token is None:
+                return items, result.get("nextSyncToken")
+
+    def _list_request(self, calendar_id: str, sync_token: Optional[str], page_token: Optional[str]) -> HttpRequest:
+        return self.service.events().list(
+            calendarId=calendar_id, singleEvents=True, syncToken=sync_token, pageToken=page_token
+        )
+
+    def _min_date(self, min_date: Optional[datetime]) -> datetime:
         if min_date is None:
-            min_date = datetime.now().astimezone(dt.timezone.utc)
-        result = (
-            self.service.events()
-            .list(calendarId=calendar_id, orderBy="startTime", singleEvents=True, timeMin=min_date.isoformat())
-            .execute()
-            .get("items", [])
+            return datetime.now().astimezone(dt.timezone.utc)
+        return min_date.astimezone(dt.timezone.utc)
+
+
+class _CalendarCache:
+    """The locally cached events of a single calendar along with the token needed to incrementally sync it."""
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.sync_token: Optional[str] = None
+        self.synced_at = -inf
+        self.refreshing = False
+        self.events: dict[str, CalendarEvent] = {}  # EventID: Event
+        # Start dates and events sorted by start date, replaced as a whole so it can be read without the lock
+        self.index: tuple[list[datetime], list[CalendarEvent]] = ([], [])
+
+    def clear(self) -> None:
+        """Forgets all the cached events."""
+        self.sync_token = None
+        self.events = {}
+        self.index = ([], [])
+
+    def apply(self, items: list[_Event], sync_token: Optional[str]) -> None:
+        """Applies a list of changed events from the Google Calendar API to the cache."""
+        for item in items:
+            if item.get("status") == "cancelled":
+                self.events.pop(item.get("id", ""), None)
+            elif item.get("start") is not None and item.get("end") is not None:
+                self.events[item.get("id", "")] = self._to_calendar_event(item)
+        if items:
+            events = sorted(self.events.values(), key=lambda event: event.start)
+            self.index = ([event.start for event in events], events)
+        self.sync_token = sync_token
+        self.synced_at = monotonic()
+
+    def _to_calendar_event(self, event: _Event) -> CalendarEvent:
+        return CalendarEvent(
+            event.get("summary", ""), self._to_datetime(event["start"]), self._to_datetime(event["end"])
         )
-        for event in result:
-            name = event.get("summary")
-            start = (
-                event.get("start").get("date")
-                if event.get("start").get("dateTime") is None
-                else event.get("start").get("dateTime")
-            )
-            end = (
-                event.get("end").get("date")
-                if event.get("end").get("dateTime") is None
-                else event.get("end").get("dateTime")
-            )
-            start = datetime.fromisoformat(start).astimezone(dt.timezone.utc)
-            end = datetime.fromisoformat(end).astimezone(dt.timezone.utc)
-            events.append(CalendarEvent(name, start, end))
-        return events
 
-    def get_next_event(self, calendar: str, min_date: Optional[datetime] = None) -> Optional[CalendarEvent]:
-        """Returns a tuple structured with the event's name, event's start date and event's end date
-        or None if there is no next event."""
-        events = self.get_events(calendar, min_date)
-        if events:
-            return events[0]
-        return None
+    def _to_datetime(self, when: _EventTime) -> datetime:
+        return datetime.fromisoformat(when.get("dateTime") or when["date"]).astimezone(dt.timezone.utc)
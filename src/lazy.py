@@ -0,0 +1,63 @@
+"""Contains Lazy which starts one of Doorbell's slower subsystems in the background, so that Doorbell
+can connect to Slack and handle events without waiting for Google, audio and text to speech to be ready."""
+
+import asyncio
+import logging
+from concurrent.futures import Future
+from threading import Thread
+from typing import Callable, Generic, Optional, TypeVar
+
+import metrics
+
+T = TypeVar("T")
+logger = logging.getLogger(__name__)
+
+
+class WarmingUp(Exception):
+    """A subsystem was used before it finished starting, the message is its name."""
+
+
+class Lazy(Generic[T]):
+    """A value that's created by a factory on its own background thread once start() is called.
+    Any number of them can be starting at the same time. get() never waits for it, use wait() for that."""
+
+    def __init__(self, name: str, factory: Callable[[], T]) -> None:
+        self.name = name
+        self.factory = factory
+        self._future: Future[T] = Future()
+
+    def start(self) -> "Lazy[T]":
+        """Starts creating the value in the background if it isn't already."""
+        if self._future.set_running_or_notify_cancel():
+            Thread(target=self._create, name=f"Start {self.name}", daemon=True).start()
+        return self
+
+    def get(self) -> T:
+        """Returns the value, raising WarmingUp if it isn't ready yet or whatever the factory raised."""
+        if not self._future.done():
+            raise WarmingUp(self.name)
+        return self._future.result()
+
+    def wait(self, timeout: Optional[float] = None) -> T:
+        """Blocks until the value is ready and returns it."""
+        return self._future.result(timeout)
+
+    async def wait_async(self) -> T:
+        """Waits on the running event loop until the value is ready and returns it."""
+        return await asyncio.wrap_future(self._future)
+
+    def when_ready(self, callback: Callable[[T], object]) -> None:
+        """Calls callback with the value once it's ready, right away if it already is.
+        It's never called if the factory fails."""
+        self._future.add_done_callback(lambda future: future.exception() is None and callback(future.result()))
+
+    def _create(self) -> None:
+        try:
+            with metrics.timed("startup", subsystem=self.name):
+                value = self.factory()
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            logger.exception("Couldn't start %s.", self.name)
+            self._future.set_exception(error)
+            return
+        logger.info("Started %s.", self.name)
+        self._future.set_result(value)
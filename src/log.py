@@ -0,0 +1,148 @@
+"""Sets up Doorbell's logging. Whoever logs only puts the record on a queue and a background thread
+writes it out, so logging never blocks on the disk. With -l records are written as JSON lines to
+log files that are rotated by size so a long running Doorbell can't fill up the disk.
+Levels can be set per module through the DOORBELL_LOG_LEVELS environment variable,
+e.g. DOORBELL_LOG_LEVELS="root=WARNING,database=DEBUG"."""
+
+import atexit
+import copy
+import json
+import logging
+import os
+import sys
+import threading
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from pathlib import Path
+from queue import SimpleQueue
+from time import perf_counter
+from types import TracebackType
+from typing import Any, Final, Iterator, Optional
+
+LOG_DIR: Final = "./logs/"
+FILE_NAME: Final = "doorbell.log"
+MAX_BYTES: Final = 10 * 1024 * 1024
+BACKUP_COUNT: Final = 9  # At most 100 MB of logs are kept
+FIELDS: Final = ("channel", "user", "command", "latency")  # Extra fields that get their own key in the JSON
+LEVELS: Final = {  # Libraries that are too chatty at INFO
+    "slack_bolt": logging.WARNING,
+    "slack_sdk": logging.WARNING,
+    "googleapiclient": logging.WARNING,
+    "websockets": logging.WARNING,
+    "urllib3": logging.WARNING,
+}
+_listener: Optional[QueueListener] = None  # pylint: disable=invalid-name
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one line of JSON including any of FIELDS passed in through extra,
+    and its traceback and stack under exc_info and stack_info if it has them."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        for name in FIELDS:
+            if hasattr(record, name):
+                entry[name] = getattr(record, name)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc_info"] = record.exc_text
+        if record.stack_info:
+            entry["stack_info"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, default=str)
+
+
+class _QueueHandler(QueueHandler):
+    """A QueueHandler that keeps the traceback and stack out of the message, so that the
+    formatter on the other end of the queue can put them where it wants."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:  # Tracebacks hold on to every frame, only their text is queued
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup(to_file: bool = False) -> None:
+    """Routes all logging through a queue to the console, or to rotating JSON log files under LOG_DIR
+    if to_file is True. Only the first call does anything."""
+    global _listener  # pylint: disable=global-statement
+    if _listener is not None:
+        return
+    handler: logging.Handler
+    if to_file:
+        Path(LOG_DIR).mkdir(exist_ok=True)
+        handler = RotatingFileHandler(
+            LOG_DIR + FILE_NAME, maxBytes=MAX_BYTES, backupCount=BACKUP_COUNT, encoding="utf-8"
+        )
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    queue: SimpleQueue[logging.LogRecord] = SimpleQueue()
+    root = logging.getLogger()
+    root.handlers = [_QueueHandler(queue)]
+    root.setLevel(logging.INFO)
+    levels: dict[str, int | str] = {**LEVELS, **_levels_from_environment()}
+    for name, level in levels.items():
+        logging.getLogger(name).setLevel(level)
+    _listener = QueueListener(queue, handler)
+    _listener.start()
+    atexit.register(stop)
+    sys.excepthook = _log_exception
+    threading.excepthook = _log_thread_exception
+
+
+def stop() -> None:
+    """Writes out the records that are still queued and stops the background thread."""
+    global _listener  # pylint: disable=global-statement
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+@contextmanager
+def timed(logger: logging.Logger, message: str, *args: Any, **fields: Any) -> Iterator[None]:
+    """Logs a message at INFO once the block is done, with how long it took in seconds as the latency field.
+    >>> with log.timed(logger, "Ran %s", cmd, channel=channel_id, user=user_id, command=cmd): ..."""
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        logger.info(message, *args, extra={**fields, "latency": round(perf_counter() - start, 6)})
+
+
+def _levels_from_environment() -> dict[str, str]:
+    levels = {}
+    for entry in os.environ.get("DOORBELL_LOG_LEVELS", "").split(","):
+        name, _, level = entry.partition("=")
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def _log_exception(
+    exc_type: type[BaseException],
+    exc_value: BaseException,
+    exc_traceback: Optional[TracebackType],
+    thread: Optional[str] = None,
+) -> None:
+    where = f" in {thread}" if thread else ""
+    logging.getLogger(__name__).critical("Uncaught exception%s", where, exc_info=(exc_type, exc_value, exc_traceback))
+
+
+def _log_thread_exception(args: threading.ExceptHookArgs) -> None:
+    thread = args.thread.name if args.thread else None
+    if args.exc_value is None:  # No exception to take a traceback from
+        logging.getLogger(__name__).critical("Uncaught %s in %s", args.exc_type.__name__, thread)
+        return
+    _log_exception(args.exc_type, args.exc_value, args.exc_traceback, thread)
@@ -1,26 +1,31 @@
-"""Run this file to start Doorbell normally."""
+"""Run this file to start Doorbell normally. Add --async to run Doorbell on an asyncio event loop."""
 
+import logging
 import os
 import sys
 import threading
 
+import log
+from async_doorbell import AsyncDoorbell
 from doorbell import Doorbell
 
+logger = logging.getLogger(__name__)
+
 if __name__ == "__main__":
     # The main thread sits here until Doorbell is closed by a command and then joins up with
     # all the other threads that have been cleaned up by Doorbell#close(), restarting if needed
-    doorbell = Doorbell()
-    print("Started Doorbell!")
+    doorbell = AsyncDoorbell() if "--async" in sys.argv else Doorbell()
+    logger.info("Started Doorbell!")
     try:
-        while not doorbell.closed:
-            pass
+        doorbell.run()
     except KeyboardInterrupt:
-        print("KeyboardInterrupt detected.")
+        logger.info("KeyboardInterrupt detected.")
         doorbell.close()
     for thread in threading.enumerate():
         if thread == threading.current_thread() or thread.daemon:
             continue
         thread.join()
-    print("Exited Doorbell.")
+    logger.info("Exited Doorbell.")
+    log.stop()  # Everything has to be written out before execl() replaces this process
     if doorbell.restarting:
         os.execl(sys.executable, f"{sys.executable}", *sys.argv)
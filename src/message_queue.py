@@ -0,0 +1,139 @@
+"""Contains the MessageQueue which sends Slack messages in the background."""
+
+import logging
+from dataclasses import dataclass
+from queue import Empty, Full, Queue
+from threading import Lock, Thread
+from time import monotonic, sleep
+from typing import Callable, Final, Optional
+
+from slack_sdk import WebClient
+from slack_sdk.errors import SlackApiError
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class _Job:
+    """A call to a Slack API method waiting to be sent."""
+
+    method: str
+    send: Callable[[], None]
+    description: str
+
+
+class MessageQueue:
+    """Sends Slack messages from a bounded pool of worker threads so that handlers never wait on Slack.
+    When Slack rate limits a method the call is retried after the Retry-After delay it asks for,
+    and other calls to that method wait too."""
+
+    MAX_GROUP_SIZE: Final = 8  # Most users a multi-person DM can have besides Doorbell
+    MAX_ATTEMPTS: Final = 5
+    CLOSE_TIMEOUT_SECONDS: Final = 5.0  # How long close() waits for room in a full queue before dropping it
+
+    def __init__(self, client: WebClient, workers: int = 4, max_size: int = 1000) -> None:
+        self.client = client
+        self._queue: Queue[Optional[_Job]] = Queue(max_size)
+        self._blocked_until: dict[str, float] = {}  # Method: Time it can be called again
+        self._lock = Lock()
+        self._workers = [Thread(target=self._work, name=f"Message Queue {i}") for i in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def post_message(self, channel_id: str, message: str) -> None:
+        """Queues a message to be posted to a Slack channel or user."""
+        self._submit(
+            _Job(
+                "chat.postMessage",
+                lambda: self._chat_post_message(channel_id, message),
+                f'Posted "{message}" to {channel_id}.',
+            )
+        )
+
+    def post_group_message(self, users: set[str], message: str) -> None:
+        """Queues a message to be posted to multi-person DMs containing the users,
+        splitting them into groups if there are too many for one DM."""
+        ordered = sorted(users)
+        for i in range(0, len(ordered), self.MAX_GROUP_SIZE):
+            group = ordered[i : i + self.MAX_GROUP_SIZE]
+            self._submit(
+                _Job(
+                    "conversations.open",
+                    lambda group=group: self._post_to_group(group, message),  # type: ignore
+                    f'Posted "{message}" to {", ".join(group)}.',
+                )
+            )
+
+    def close(self) -> None:
+        """Sends the rest of the queued messages and then stops the workers. If the queue stays full for
+        CLOSE_TIMEOUT_SECONDS, e.g. while Slack is rate limiting, the queued messages are dropped instead
+        so that every worker still gets told to stop."""
+        stopping = 0  # Workers that have been told to stop
+        while stopping < len(self._workers):
+            try:
+                self._queue.put(None, timeout=self.CLOSE_TIMEOUT_SECONDS)
+                stopping += 1
+            except Full:
+                dropped = 0
+                while True:
+                    try:
+                        job = self._queue.get_nowait()
+                    except Empty:
+                        break
+                    if job is None:
+                        stopping -= 1  # Queued again with the rest
+                    else:
+                        dropped += 1
+                logger.error("Message queue is still full, dropped %s messages to stop.", dropped)
+
+    def _submit(self, job: _Job) -> None:
+        try:
+            self._queue.put_nowait(job)
+        except Full:
+            logger.error("Message queue is full, dropped: %s", job.description)
+
+    def _work(self) -> None:
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            try:
+                self._run(job)
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.exception("Couldn't send: %s", job.description)  # e.g. a network error, keep the worker alive
+
+    def _run(self, job: _Job) -> None:
+        for _ in range(self.MAX_ATTEMPTS):
+            self._wait_for_rate_limit(job.method)
+            try:
+                job.send()
+            except SlackApiError as error:
+                if error.response.status_code != 429:
+                    logger.error("Slack Error: %s", error)
+                    return
+                method = error.response.api_url.rsplit("/", 1)[-1]
+                retry_after = float(error.response.headers.get("Retry-After", 1))
+                with self._lock:
+                    blocked_until = max(self._blocked_until.get(method, 0), monotonic() + retry_after)
+                    self._blocked_until[method] = blocked_until
+                logger.warning("Rate limited on %s, retrying in %s seconds.", method, retry_after)
+            else:
+                logger.info(job.description)
+                return
+        logger.error("Gave up after %s attempts: %s", self.MAX_ATTEMPTS, job.description)
+
+    def _wait_for_rate_limit(self, method: str) -> None:
+        delay = self._blocked_until.get(method, 0) - monotonic()
+        if delay > 0:
+            sleep(delay)
+
+    def _chat_post_message(self, channel_id: str, message: str) -> None:
+        self.client.chat_postMessage(channel=channel_id, text=message, unfurl_links=False, unfurl_media=False)
+
+    def _post_to_group(self, users: list[str], message: str) -> None:
+        if len(users) == 1:
+            self._chat_post_message(users[0], message)
+            return
+        channel = self.client.conversations_open(users=",".join(users))["channel"]["id"]  # type: ignore
+        self._wait_for_rate_limit("chat.postMessage")
+        self._chat_post_message(channel, message)
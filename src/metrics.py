@@ -0,0 +1,140 @@
+"""Contains the latency metrics that Doorbell records about itself. Wrap anything worth timing in timed(),
+which works as both a context manager and a decorator, and read the results with to_prometheus() or summary()."""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import perf_counter
+from typing import Any, Final, Iterator
+
+from slack_sdk import WebClient
+from slack_sdk.web import SlackResponse
+
+PREFIX: Final = "doorbell_"
+PORT: Final = 8766
+BUCKETS: Final = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # Seconds
+_LOCK: Final = Lock()
+_HISTOGRAMS: dict[tuple[str, tuple[tuple[str, str], ...]], "Histogram"] = {}  # (Name, Labels): Histogram
+
+
+class Histogram:
+    """Counts how long something took into fixed buckets, the same way a Prometheus histogram does."""
+
+    def __init__(self, name: str, labels: tuple[tuple[str, str], ...]) -> None:
+        self.name = name
+        self.labels = labels
+        self.counts = [0] * (len(BUCKETS) + 1)  # The last bucket is everything slower than BUCKETS[-1]
+        self.count = 0
+        self.sum = 0.0
+        self._lock = Lock()
+
+    def observe(self, seconds: float) -> None:
+        """Records one measurement."""
+        i = bisect_left(BUCKETS, seconds)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += seconds
+
+    def snapshot(self) -> tuple[list[int], int, float]:
+        """Returns the bucket counts, count and sum as of one moment, so they agree with each other."""
+        with self._lock:
+            return list(self.counts), self.count, self.sum
+
+    def quantile(self, q: float) -> float:
+        """Returns the upper bound of the bucket the q-quantile falls in, e.g. q=0.99 for p99."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+def histogram(name: str, **labels: str) -> Histogram:
+    """Returns the histogram for a metric name and set of labels, creating it if needed."""
+    key = (name, tuple(sorted(labels.items())))
+    found = _HISTOGRAMS.get(key)
+    if found is not None:
+        return found
+    with _LOCK:
+        return _HISTOGRAMS.setdefault(key, Histogram(*key))
+
+
+@contextmanager
+def timed(name: str, **labels: str) -> Iterator[None]:
+    """Records how long the block or decorated function took in seconds.
+    >>> with timed("calendar_sync", calendar="Build Season"): ..."""
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        histogram(name, **labels).observe(perf_counter() - start)
+
+
+def to_prometheus() -> str:
+    """Returns every histogram in the Prometheus text exposition format."""
+    lines: list[str] = []
+    histograms = list(_HISTOGRAMS.items())  # Other threads can add histograms while this runs
+    for name in sorted({name for (name, _), _ in histograms}):
+        metric = f"{PREFIX}{name}_seconds"
+        lines.append(f"# TYPE {metric} histogram")
+        for hist in [hist for (n, _), hist in histograms if n == name]:
+            labels = "".join(f'{key}="{value}",' for key, value in hist.labels)
+            counts, total, seconds = hist.snapshot()
+            cumulative = 0
+            for bound, count in zip([*BUCKETS, "+Inf"], counts):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{{labels}le="{bound}"}} {cumulative}')
+            labels = "{" + labels.rstrip(",") + "}" if labels else ""
+            lines.append(f"{metric}_sum{labels} {seconds}")
+            lines.append(f"{metric}_count{labels} {total}")
+    return "\n".join(lines) + "\n"
+
+
+def summary() -> str:
+    """Returns a short human readable line for each histogram."""
+    lines = []
+    for hist in sorted(list(_HISTOGRAMS.values()), key=lambda hist: (hist.name, hist.labels)):
+        labels = ", ".join(value for _, value in hist.labels)
+        name = f"{hist.name} ({labels})" if labels else hist.name
+        lines.append(
+            f"{name}: {hist.count} calls, avg {hist.sum / hist.count * 1000:.1f} ms,"
+            f" p50 <= {hist.quantile(0.5) * 1000:g} ms, p99 <= {hist.quantile(0.99) * 1000:g} ms"
+        )
+    return "\n".join(lines) if lines else "No metrics recorded yet."
+
+
+def start_server(port: int = PORT) -> ThreadingHTTPServer:
+    """Serves to_prometheus() at http://localhost:port/metrics from a background thread.
+    Stop it with shutdown()."""
+    metrics_server = ThreadingHTTPServer(("localhost", port), _MetricsHandler)
+    Thread(target=metrics_server.serve_forever, name="Metrics Server", daemon=True).start()
+    return metrics_server
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        """Responds with the metrics."""
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = to_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_: Any) -> None:  # pylint: disable=arguments-differ
+        pass
+
+
+class TimedWebClient(WebClient):
+    """A Slack WebClient that records how long every API call takes, labeled by API method."""
+
+    def api_call(self, api_method: str, *args: Any, **kwargs: Any) -> SlackResponse:  # type: ignore[override]
+        with timed("slack_api", method=api_method):
+            return super().api_call(api_method, *args, **kwargs)
@@ -0,0 +1,74 @@
+"""Contains the hot reload behind restart and update. Modules in RELOADABLE are re-imported in place so that
+Doorbell keeps its Slack connection and caches, anything else that changed needs a full restart."""
+
+import importlib
+import logging
+import os
+import sys
+from pathlib import Path
+from types import CodeType, FunctionType, ModuleType
+from typing import Final
+
+logger = logging.getLogger(__name__)
+RELOADABLE: Final = ("slash_commands.roles_command", "doorbell", "async_doorbell")  # Dependencies come first
+SOURCE_DIR: Final = Path(__file__).resolve().parent
+_LOADED: Final[dict[str, float]] = {}  # Module: Modified time of its file at startup or when it was reloaded
+
+
+def watch() -> None:
+    """Remembers when every Doorbell module under SOURCE_DIR was last changed, including the ones
+    that haven't been imported yet, since those are imported from whatever is on disk when they are."""
+    for name, modified in _source_modules().items():
+        _LOADED.setdefault(name, modified)
+
+
+def changed_modules() -> list[str]:
+    """Returns the Doorbell modules whose files have changed or been added since watch()."""
+    return [name for name, modified in _source_modules().items() if _LOADED.get(name) != modified]
+
+
+def can_reload(changed: list[str]) -> bool:
+    """Whether every changed module can be hot reloaded."""
+    return bool(changed) and all(name in RELOADABLE for name in changed)
+
+
+def reload(changed: list[str]) -> dict[str, ModuleType]:
+    """Re-imports the changed modules along with every module after them in RELOADABLE, since those
+    import from them. Returns the reloaded modules by name. If a module fails to import the ones
+    before it have already been reloaded, so the caller should fall back to a full restart."""
+    first = min(RELOADABLE.index(name) for name in changed)
+    reloaded = {}
+    for name in RELOADABLE[first:]:
+        module = sys.modules.get(name)
+        if module is None:
+            continue
+        reloaded[name] = importlib.reload(module)
+        _LOADED[name] = _modified(module)
+        logger.info("Reloaded %s.", name)
+    return reloaded
+
+
+def same_code(old: FunctionType, new: FunctionType) -> bool:
+    """Whether two versions of a function do the same thing, ignoring where they are in their file."""
+    return _without_lines(old.__code__) == _without_lines(new.__code__)
+
+
+def _without_lines(code: CodeType) -> CodeType:
+    consts = tuple(_without_lines(const) if isinstance(const, CodeType) else const for const in code.co_consts)
+    return code.replace(co_firstlineno=1, co_linetable=b"", co_consts=consts)
+
+
+def _source_modules() -> dict[str, float]:
+    modules = {}
+    for path in SOURCE_DIR.rglob("*.py"):
+        parts = path.relative_to(SOURCE_DIR).with_suffix("").parts
+        name = ".".join(parts[:-1] if parts[-1] == "__init__" else parts)
+        modules[name] = path.stat().st_mtime
+    return modules
+
+
+def _modified(module: ModuleType) -> float:
+    try:
+        return os.stat(module.__file__ or "").st_mtime
+    except OSError:
+        return 0.0
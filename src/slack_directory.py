@@ -0,0 +1,110 @@
+"""Contains the SlackDirectory which caches the names of Slack users and channels."""
+
+import logging
+from threading import Lock
+from time import monotonic
+from typing import Any, Final, Optional, cast
+
+from slack_bolt import App
+from slack_sdk import WebClient
+from slack_sdk.web import SlackResponse
+
+logger = logging.getLogger(__name__)
+
+
+class SlackDirectory:
+    """Caches the names of Slack users and channels so that they don't have to be looked up on every event.
+    Names expire after TTL_SECONDS and are kept up to date through the user_change and channel_rename events.
+    To keep the directory up to date call register(app)."""
+
+    TTL_SECONDS: Final = 6 * 60 * 60
+    PAGE_SIZE: Final = 200
+
+    def __init__(self, client: WebClient) -> None:
+        self.client = client
+        self._users: dict[str, tuple[str, float]] = {}  # UserID: (Name, Expiry)
+        self._channels: dict[str, tuple[str, float]] = {}  # ChannelID: (Name, Expiry)
+        self._workspace_url: Optional[str] = None
+        self._warm_lock = Lock()
+
+    def register(self, app: App) -> None:
+        """Registers the events that keep the directory up to date with your Slack app."""
+        app.event("user_change")(self._user_change)
+        app.event("team_join")(self._user_change)
+        app.event("channel_rename")(self._channel_rename)
+        app.event("channel_created")(self._channel_rename)
+
+    def warm(self) -> None:
+        """Loads every user and channel in the workspace, one page at a time."""
+        with self._warm_lock:
+            self._workspace_url = self.client.auth_test().get("url")
+            cursor = None
+            while True:
+                result = self._data(self.client.users_list(limit=self.PAGE_SIZE, cursor=cursor))
+                for user in result.get("members", []):
+                    self._set_user(user)
+                cursor = result.get("response_metadata", {}).get("next_cursor")
+                if not cursor:
+                    break
+            while True:
+                result = self._data(
+                    self.client.conversations_list(
+                        limit=self.PAGE_SIZE,
+                        cursor=cursor,
+                        exclude_archived=True,
+                        types="public_channel,private_channel",
+                    )
+                )
+                for channel in result.get("channels", []):
+                    self._set_channel(channel)
+                cursor = result.get("response_metadata", {}).get("next_cursor")
+                if not cursor:
+                    break
+        logger.info("Loaded %s users and %s channels into the directory.", len(self._users), len(self._channels))
+
+    def user_name(self, user_id: str) -> str:
+        """Returns the real name of a Slack user given their user id."""
+        cached = self._users.get(user_id)
+        if cached is not None and cached[1] > monotonic():
+            return cached[0]
+        user = self._data(self.client.users_info(user=user_id))["user"]
+        return self._set_user(user)
+
+    def channel_name(self, channel_id: str) -> str:
+        """Returns the name of a Slack channel given its channel id."""
+        cached = self._channels.get(channel_id)
+        if cached is not None and cached[1] > monotonic():
+            return cached[0]
+        channel = self._data(self.client.conversations_info(channel=channel_id))["channel"]
+        if channel is None:
+            return "None"
+        return self._set_channel(channel)
+
+    def permalink(self, channel_id: str, ts: str, thread_ts: Optional[str] = None) -> str:
+        """Returns a link to a message. It's built from the workspace url when possible
+        instead of asking Slack for it."""
+        if self._workspace_url is None:
+            return self.client.chat_getPermalink(channel=channel_id, message_ts=ts).get("permalink", "")
+        link = f"{self._workspace_url}archives/{channel_id}/p{ts.replace('.', '')}"
+        if thread_ts is not None and thread_ts != ts:
+            link += f"?thread_ts={thread_ts}&cid={channel_id}"
+        return link
+
+    def _user_change(self, event: dict) -> None:
+        self._set_user(event["user"])
+
+    def _channel_rename(self, event: dict) -> None:
+        self._set_channel(event["channel"])
+
+    def _data(self, response: SlackResponse) -> dict[str, Any]:
+        return cast(dict[str, Any], response.data)  # Web API methods always respond with a JSON object
+
+    def _set_user(self, user: dict) -> str:
+        name = user.get("real_name") or user.get("profile", {}).get("real_name") or user.get("name", "None")
+        self._users[user["id"]] = (name, monotonic() + self.TTL_SECONDS)
+        return name
+
+    def _set_channel(self, channel: dict) -> str:
+        name = channel.get("name", "None")
+        self._channels[channel["id"]] = (name, monotonic() + self.TTL_SECONDS)
+        return name
@@ -1,5 +1,6 @@
 """Logic for the /roles command. Allows for assigning roles to different users and managing which roles exist."""
 
+import logging
 import random
 import string
 from typing import Final
@@ -20,6 +21,8 @@ from slack_sdk.models.views import View
 
 import database
 
+logger = logging.getLogger(__name__)
+
 
 class RolesCommand:
     """Contains all the functionality pertaining to the /roles command.
@@ -144,11 +147,9 @@ class RolesCommand:
         user = values[self.USER_SELECT_BLOCK_ID][self.USER_SELECT_ACTION_ID]["selected_user"]
         selected = values.get(role_select_block_id, {}).get(self.ROLE_SELECT_ACTION_ID, {}).get("selected_options", [])
         roles = {role["value"] for role in selected}
-        data = database.read()
-        data.set_roles(user, roles)
-        database.write(data)
+        database.set_user_roles(user, roles)
         initiator = body.get("user", {}).get("id", "")
-        print(f"{initiator} set roles for {user} to {roles}.")
+        logger.info("%s set roles for %s to %s.", initiator, user, roles, extra={"user": initiator})
 
     def _roles_manage_submit(self, ack: Ack, view: dict, body: dict, client: WebClient) -> None:
         ack()
@@ -164,14 +165,16 @@ class RolesCommand:
             .get("selected_options", [])
         )
         roles_to_remove = [option["value"] for option in roles_to_remove]
-        data = database.read()
-        for role in roles_to_add:
-            data.add_role(role)
-        for role in roles_to_remove:
-            data.remove_role(role)
-        database.write(data)
+        database.add_roles(roles_to_add)
+        database.remove_roles(roles_to_remove)
         initiator = body.get("user", {}).get("id", "")
-        print(f"{initiator} added roles {roles_to_add} and removed roles {roles_to_remove}.")
+        logger.info(
+            "%s added roles %s and removed roles %s.",
+            initiator,
+            roles_to_add,
+            roles_to_remove,
+            extra={"user": initiator},
+        )
         self._roles_update_view(view["private_metadata"], view["root_view_id"], client)
 
     def _generate_options(self, roles: set[str]) -> list[Option]:
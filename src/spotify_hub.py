@@ -0,0 +1,187 @@
+"""Contains the SpotifyHub which sends songs to every Spotify client running the Spicetify extension."""
+
+import asyncio
+import itertools
+import json
+import logging
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from threading import Event, Thread
+from typing import Final, Optional
+
+from websockets.asyncio.server import ServerConnection, serve
+from websockets.exceptions import ConnectionClosed
+
+logger = logging.getLogger(__name__)
+
+
+class SpotifyError(Exception):
+    """Spotify couldn't queue a request, the message says why."""
+
+
+@dataclass
+class _Client:
+    """A connected Spicetify extension."""
+
+    connection: ServerConnection
+    outbox: asyncio.Queue[str]
+    acks: dict[int, asyncio.Future[int]] = field(default_factory=dict)  # Request ID: Ack
+
+
+class SpotifyHub:
+    """A websocket server that the Spicetify extension connects to. Requests are sent to the most recently
+    connected Spotify client through a bounded queue and are done once the extension acknowledges them.
+    Requests made while no client is connected are buffered and sent when one connects. Dead connections
+    are noticed through ping/pong heartbeats. Either call start() to run it on its own thread or
+    await serve() on an existing event loop."""
+
+    HOST: Final = "localhost"
+    PORT: Final = 8765
+    HEARTBEAT_SECONDS: Final = 20  # How often to ping and how long to wait for the pong
+    ACK_TIMEOUT_SECONDS: Final = 10
+    MAX_QUEUED: Final = 100  # Per client
+    MAX_BUFFERED: Final = 100  # While disconnected
+
+    def __init__(self) -> None:
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._server_task: Optional[asyncio.Task] = None
+        self._clients: list[_Client] = []  # Oldest first
+        self._buffer: deque[tuple[dict, asyncio.Future[int]]] = deque()  # (Request, Ack)
+        self._ids = itertools.count()
+        self._replays: set[asyncio.Task] = set()  # Holds onto the tasks so they aren't garbage collected
+        self._stopped = Event()  # Set by stop(), even before serve() has started running
+
+    @property
+    def connected(self) -> bool:
+        """Whether any Spotify client is connected."""
+        return bool(self._clients)
+
+    def start(self) -> None:
+        """Runs the hub on a new thread with its own event loop until stop() is called."""
+        Thread(target=asyncio.run, args=(self.serve(),), name="Spotify Hub").start()
+
+    def stop(self) -> None:
+        """Stops the hub and disconnects every client. Safe to call from any thread, if the hub hasn't
+        started running yet it stops as soon as it does. It can't be started again afterwards."""
+        self._stopped.set()
+        loop, task = self._loop, self._server_task
+        if loop is not None and task is not None:
+            loop.call_soon_threadsafe(task.cancel)
+
+    async def serve(self) -> None:
+        """Accepts Spicetify connections on the running event loop until cancelled or stop() is called."""
+        self._loop = asyncio.get_running_loop()
+        self._server_task = asyncio.current_task()
+        try:
+            if self._stopped.is_set():  # stop() was called before there was a task to cancel
+                return
+            async with serve(
+                self._on_connection,
+                self.HOST,
+                self.PORT,
+                ping_interval=self.HEARTBEAT_SECONDS,
+                ping_timeout=self.HEARTBEAT_SECONDS,
+            ):
+                await asyncio.Future()  # Forever
+        except asyncio.CancelledError:
+            pass
+        except OSError:
+            logger.exception("Couldn't start the Spotify Hub on port %s.", self.PORT)
+        finally:
+            self._loop = None
+            self._server_task = None
+            for _, ack in self._buffer:
+                ack.cancel()
+            self._buffer.clear()
+            logger.info("Stopped Spotify Hub.")
+
+    def play(self, urls: list[str]) -> Future[int]:
+        """Asks Spotify to add tracks, albums and playlists to its queue in one request. Never blocks,
+        the returned future holds how many tracks Spotify queued and raises SpotifyError if it couldn't
+        queue them. Safe to call from any thread."""
+        if self._loop is None:
+            future: Future[int] = Future()
+            future.set_exception(SpotifyError("Doorbell's Spotify hub isn't running."))
+            return future
+        request = {"id": next(self._ids), "type": "play", "urls": urls}
+        return asyncio.run_coroutine_threadsafe(self._request(request), self._loop)
+
+    async def _request(self, request: dict) -> int:
+        for client in reversed(self._clients):  # The newest client is most likely the one in use
+            try:
+                return await self._send(client, request)
+            except (ConnectionClosed, asyncio.QueueFull):
+                continue
+        ack: asyncio.Future[int] = asyncio.get_running_loop().create_future()
+        if len(self._buffer) >= self.MAX_BUFFERED:
+            _, oldest = self._buffer.popleft()
+            oldest.set_exception(SpotifyError("Too many requests were made while Spotify was disconnected."))
+        self._buffer.append((request, ack))
+        return await ack
+
+    async def _send(self, client: _Client, request: dict) -> int:
+        ack: asyncio.Future[int] = asyncio.get_running_loop().create_future()
+        client.outbox.put_nowait(json.dumps(request))
+        client.acks[request["id"]] = ack
+        try:
+            return await asyncio.wait_for(ack, self.ACK_TIMEOUT_SECONDS)
+        except TimeoutError as error:
+            raise SpotifyError("Spotify didn't respond in time.") from error
+        finally:
+            client.acks.pop(request["id"], None)
+
+    async def _on_connection(self, connection: ServerConnection) -> None:
+        client = _Client(connection, asyncio.Queue(self.MAX_QUEUED))
+        self._clients.append(client)
+        logger.info("Spicetify has connected! (%s connected)", len(self._clients))
+        writer = asyncio.create_task(self._write(client))
+        while self._buffer:
+            request, ack = self._buffer.popleft()
+            replay = asyncio.create_task(self._replay(request, ack))
+            self._replays.add(replay)
+            replay.add_done_callback(self._replays.discard)
+        try:
+            async for message in connection:
+                self._on_message(client, message)
+        except ConnectionClosed:
+            pass
+        finally:
+            self._clients.remove(client)
+            writer.cancel()
+            for ack in client.acks.values():
+                if not ack.done():
+                    ack.set_exception(ConnectionClosed(None, None))
+            logger.info("Spicetify has disconnected. (%s connected)", len(self._clients))
+
+    async def _write(self, client: _Client) -> None:
+        while True:
+            message = await client.outbox.get()
+            try:
+                await client.connection.send(message)
+            except ConnectionClosed:
+                return
+
+    async def _replay(self, request: dict, ack: asyncio.Future[int]) -> None:
+        try:
+            queued = await self._request(request)
+        except SpotifyError as error:
+            if not ack.done():
+                ack.set_exception(error)
+        else:
+            if not ack.done():
+                ack.set_result(queued)
+
+    def _on_message(self, client: _Client, message: str | bytes) -> None:
+        try:
+            response = json.loads(message)
+            ack = client.acks.get(response["id"])
+        except (ValueError, KeyError, TypeError):
+            logger.warning("Spicetify sent an invalid message: %s", message)
+            return
+        if ack is None or ack.done():
+            return
+        if response.get("ok"):
+            ack.set_result(response.get("queued", 0))
+        else:
+            ack.set_exception(SpotifyError(response.get("error", "Spotify couldn't queue it.")))
@@ -1,73 +1,53 @@
-"""Contains the class for using text to speech on Windows."""
+"""Contains the interface for text to speech backends and create_tts() for picking one."""
 
-from concurrent.futures import Future, wait
-from ctypes import WinError
-from time import sleep
-from typing import TypeVar
+import sys
+from abc import ABC, abstractmethod
+from time import monotonic
+from typing import Generic, Optional, TypeVar
 
-from winrt.windows.foundation import AsyncStatus, IAsyncOperation
-from winrt.windows.media.core import MediaSource
-from winrt.windows.media.playback import IMediaPlaybackSource, MediaPlayer
-from winrt.windows.media.speechsynthesis import SpeechSynthesizer
-from winrt.windows.storage.streams import IRandomAccessStream
+Speech = TypeVar("Speech")
 
 
-class TTS:
-    """Enables the use of text to speech on Windows through the say() method."""
+class TTS(ABC, Generic[Speech]):
+    """A text to speech backend. Speech can be said straight away with say() or stream(),
+    or synthesized ahead of time with synthesize() and played later with play()."""
 
     def __init__(self) -> None:
-        self.player = MediaPlayer()
-        self.synth = SpeechSynthesizer()
+        self.time_to_first_audio: Optional[float] = None  # Seconds from the last request until audio started
 
     def say(self, text: str, blocking: bool = False) -> None:
         """Says a string of text using text to speech. Can optionally be a blocking call.
         >>> tts_obj.say("Hello World")"""
-        stream = self._wait_for(self.synth.synthesize_text_to_stream_async(text))
-        source = MediaSource.create_from_stream(IRandomAccessStream._from(stream), stream.content_type)
-        if source is None:
-            return
-        self.player.source = IMediaPlaybackSource._from(source)
-        if blocking:
-            session = self.player.playback_session
-            if session is None:
-                return
-            time_waited: float = 0
-            while session.natural_duration.total_seconds() == 0:  # Wait until audio is loaded
-                sleep(0.1)
-                time_waited += 0.1
-                if time_waited > 5:  # Timeout after 5 seconds
-                    return
-            self.player.play()
-            sleep(session.natural_duration.total_seconds())
-        else:
-            self.player.play()
+        start = monotonic()
+        self._play(self.synthesize(text), blocking, start)
 
-    # SPDX-License-Identifier: MIT
-    # Copyright 2024 David Lechner <david@pybricks.com>
-    # https://github.com/pywinrt/pywinrt/blob/c5cc3fd54934eff02ba200b3ef665541a68194e5/samples/screen_capture/sync.py
-    _T = TypeVar("_T")
+    def stream(self, text: str) -> None:
+        """Says a string of text, starting playback before all of it has been synthesized
+        if the backend supports it. Blocks until it has been said."""
+        self.say(text, blocking=True)
 
-    def _wait_for(self, operation: IAsyncOperation[_T]) -> _T:
-        """
-        Wait for the given async operation to complete and return its result.
+    def play(self, speech: Speech, blocking: bool = False) -> None:
+        """Plays speech from synthesize(), it can be played any number of times. Can optionally be a blocking call."""
+        self._play(speech, blocking, monotonic())
 
-        For use in non-asyncio apps.
-        """
-        future = Future()
+    @abstractmethod
+    def synthesize(self, text: str) -> Speech:
+        """Synthesizes a string of text into speech that can be played with play()."""
 
-        def completed(async_op: IAsyncOperation, status: AsyncStatus):
-            try:
-                if status == AsyncStatus.COMPLETED:
-                    future.set_result(async_op.get_results())
-                elif status == AsyncStatus.ERROR:
-                    future.set_exception(WinError(async_op.error_code.value))
-                elif status == AsyncStatus.CANCELED:
-                    future.cancel()
-            except Exception as e:
-                future.set_exception(e)
+    @abstractmethod
+    def _play(self, speech: Speech, blocking: bool, start: float) -> None:
+        """Plays speech, calling _first_audio(start) as soon as it starts playing."""
 
-        operation.completed = completed
+    def _first_audio(self, start: float) -> None:
+        self.time_to_first_audio = monotonic() - start
 
-        wait([future])
 
-        return future.result()
+def create_tts() -> TTS:
+    """Creates the text to speech backend for this platform, WinRT on Windows and espeak-ng everywhere else."""
+    if sys.platform == "win32":
+        from winrt_tts import WinRTTTS  # pylint: disable=import-outside-toplevel
+
+        return WinRTTTS()
+    from espeak_tts import ESpeakTTS  # pylint: disable=import-outside-toplevel
+
+    return ESpeakTTS()
@@ -0,0 +1,389 @@
+"""Benchmarks Doorbell's hot paths without Slack or Google. The Slack Web API is stood in for by a local
+HTTP server and the Google Calendar API by a fake service, both of which count every call made to them.
+Synthetic workloads are replayed through mention_event(), message_event() and the EventPoller and
+the p50/p99 handler latency, API calls per event and database bytes read/written are reported.
+e.g. python test/benchmark.py --messages 2000 --rate 500 --roles 20 --subscriptions 100 --calendars 10"""
+
+import argparse
+import datetime as dt
+import io
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import types
+import wave
+from collections import Counter
+from contextlib import redirect_stdout
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic, perf_counter, sleep
+from typing import Any, Callable, Optional
+from urllib.parse import parse_qsl
+
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")  # The chime plays to nowhere
+os.environ.setdefault("SLACK_SIGNING_SECRET", "benchmark")  # App wants one even though it's never checked
+WORK_DIR = tempfile.mkdtemp(prefix="doorbell-benchmark-")  # Keeps the real database untouched
+CHIME_PATH = os.path.join(WORK_DIR, "chime.wav")
+with open(CHIME_PATH, "wb") as chime_file, wave.Wave_write(chime_file) as chime:
+    chime.setnchannels(1)
+    chime.setsampwidth(2)
+    chime.setframerate(22050)
+    chime.writeframes(bytes(2 * 220))  # 10ms of silence
+secret = types.ModuleType("secret")  # Stand in tokens so that the real ones are never used
+BOT_TOKEN = "xoxb-benchmark"
+secret.APP_TOKEN, secret.BOT_TOKEN, secret.SOUND_PATH = "xapp-benchmark", BOT_TOKEN, CHIME_PATH  # type: ignore
+sys.modules["secret"] = secret
+
+# pylint: disable=wrong-import-position
+from slack_bolt.context.say import Say
+
+import database
+import metrics
+from doorbell import Doorbell
+from google_calendar import GoogleCalendar
+from tts import TTS
+
+
+class SlackStub(ThreadingHTTPServer):
+    """A local stand-in for the Slack Web API that answers the methods Doorbell uses and counts every call."""
+
+    def __init__(self, users: int, channels: int) -> None:
+        super().__init__(("localhost", 0), _SlackHandler)
+        self.users = [{"id": f"U{i:06}", "real_name": f"User {i}"} for i in range(users)]
+        self.channels = [{"id": f"C{i:06}", "name": f"channel-{i}"} for i in range(channels)]
+        self.calls: Counter[str] = Counter()
+        self.messages: list[tuple[float, str, str]] = []  # (Time, Channel, Text) of every posted message
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        """The base url to give to a WebClient."""
+        return f"http://localhost:{self.server_address[1]}/api/"
+
+    def respond(self, method: str, params: dict[str, Any]) -> dict[str, Any]:  # pylint: disable=R0911
+        """Counts a call and returns the response Slack would give."""
+        with self.lock:
+            self.calls[method] += 1
+            if method == "chat.postMessage":
+                self.messages.append((monotonic(), params.get("channel", ""), params.get("text", "")))
+        if method == "auth.test":
+            return {"url": "https://benchmark.slack.com/", "team_id": "T0", "user_id": "U0", "bot_id": "B0"}
+        if method == "users.list":
+            return {"members": self.users, "response_metadata": {"next_cursor": ""}}
+        if method == "conversations.list":
+            return {"channels": self.channels, "response_metadata": {"next_cursor": ""}}
+        if method == "users.info":
+            return {"user": {"id": params.get("user"), "real_name": "Unknown User"}}
+        if method == "conversations.info":
+            return {"channel": {"id": params.get("channel"), "name": "unknown"}}
+        if method == "conversations.open":
+            return {"channel": {"id": "G" + str(abs(hash(params.get("users"))))}}
+        if method == "chat.postMessage":
+            return {"channel": params.get("channel"), "ts": f"{monotonic():.6f}"}
+        if method == "chat.getPermalink":
+            return {"permalink": "https://benchmark.slack.com/archives/" + params.get("channel", "")}
+        return {}
+
+
+class _SlackHandler(BaseHTTPRequestHandler):
+    server: SlackStub
+
+    def do_POST(self) -> None:  # pylint: disable=invalid-name
+        """Handles a Slack Web API call."""
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            params = json.loads(body or "{}")
+        else:
+            params = dict(parse_qsl(body))
+        response = json.dumps({"ok": True, **self.server.respond(self.path.rsplit("/", 1)[-1], params)}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *_: Any) -> None:  # pylint: disable=arguments-differ
+        pass
+
+
+class FakeCalendarService:
+    """A stand-in for the Google Calendar API service with calendars named Calendar 0, Calendar 1, etc.
+    The first event of every calendar starts in 30 minutes and the rest are a day apart."""
+
+    def __init__(self, calendars: int, events: int) -> None:
+        self.calls: Counter[str] = Counter()
+        now = dt.datetime.now().astimezone(dt.timezone.utc)
+        self._events: dict[str, list[dict]] = {}  # CalendarID: Events
+        for c in range(calendars):
+            starts = [now + dt.timedelta(minutes=30)] + [now + dt.timedelta(days=i) for i in range(1, events)]
+            self._events[f"calendar{c}@benchmark"] = [
+                {
+                    "id": f"{c}-{i}",
+                    "summary": f"Calendar {c} event {i}",
+                    "start": {"dateTime": start.isoformat()},
+                    "end": {"dateTime": (start + dt.timedelta(hours=1)).isoformat()},
+                }
+                for i, start in enumerate(starts)
+            ]
+
+    def calendarList(self) -> Any:  # pylint: disable=invalid-name
+        """calendarList() of the Calendar API."""
+        items = [{"id": calendar_id, "summary": f"Calendar {c}"} for c, calendar_id in enumerate(self._events)]
+        return types.SimpleNamespace(list=lambda: _FakeRequest(self.calls, "calendarList.list", {"items": items}))
+
+    def events(self) -> Any:
+        """events() of the Calendar API, incremental syncs never find any changes."""
+
+        # pylint: disable-next=invalid-name
+        def list_events(calendarId: str, syncToken: Optional[str] = None, **_: Any) -> _FakeRequest:
+            items = [] if syncToken else self._events[calendarId]
+            return _FakeRequest(self.calls, "events.list", {"items": items, "nextSyncToken": "benchmark"})
+
+        return types.SimpleNamespace(list=list_events)
+
+    def new_batch_http_request(self, callback: Callable[[str, dict, None], None]) -> "_FakeBatch":
+        """Batches requests into one call, like the Calendar API's batch endpoint."""
+        return _FakeBatch(self.calls, callback)
+
+
+@dataclass
+class _FakeRequest:
+    calls: Counter[str]
+    method: str
+    result: dict
+
+    def execute(self) -> dict:
+        """Counts the call and returns the result."""
+        self.calls[self.method] += 1
+        return self.result
+
+
+@dataclass
+class _FakeBatch:
+    calls: Counter[str]
+    callback: Callable[[str, dict, None], None]
+    requests: list[tuple[str, _FakeRequest]] = field(default_factory=list)
+
+    def add(self, request: _FakeRequest, request_id: str) -> None:
+        """Adds a request to the batch."""
+        self.requests.append((request_id, request))
+
+    def execute(self) -> None:
+        """Counts the batch and calls back with the result of each request."""
+        self.calls["batch"] += 1
+        for request_id, request in self.requests:
+            self.callback(request_id, request.execute(), None)
+
+
+class SilentTTS(TTS[str]):
+    """Text to speech that doesn't say anything."""
+
+    def synthesize(self, text: str) -> str:
+        return text
+
+    def _play(self, speech: str, blocking: bool, start: float) -> None:
+        self._first_audio(start)
+
+
+class BenchmarkDoorbell(Doorbell):
+    """Doorbell that never connects to Slack's socket mode, like MockDoorbell, but still sends its
+    messages through the Web API so that they get counted."""
+
+    def _connect_to_slack(self) -> None:
+        pass
+
+
+@dataclass
+class Result:
+    """The measurements of one workload."""
+
+    name: str
+    latencies: list[float] = field(default_factory=list)  # Seconds
+    slack_calls: Counter[str] = field(default_factory=Counter)
+    calendar_calls: Counter[str] = field(default_factory=Counter)
+    disk: Optional[tuple[int, int]] = None  # Bytes read and written
+
+    def percentile(self, p: int) -> float:
+        """Returns the latency percentile in milliseconds."""
+        if len(self.latencies) < 2:
+            return self.latencies[0] * 1000 if self.latencies else 0
+        return statistics.quantiles(self.latencies, n=100, method="inclusive")[p - 1] * 1000
+
+    def __str__(self) -> str:
+        events = max(len(self.latencies), 1)
+        calls = ", ".join(f"{m} {n / events:.2f}" for m, n in (self.slack_calls + self.calendar_calls).most_common())
+        disk = "n/a" if self.disk is None else f"{self.disk[0]:,} B read, {self.disk[1]:,} B written"
+        latency = f"p50 {self.percentile(50):.3f} ms, p99 {self.percentile(99):.3f} ms"
+        return (
+            f"{self.name}: {len(self.latencies)} events, {latency}\n"
+            f"  API calls per event: {calls or 'none'}\n"
+            f"  Database: {disk}"
+        )
+
+
+class Benchmark:
+    """Runs workloads against a BenchmarkDoorbell and measures them."""
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.slack = SlackStub(args.users, args.channels)
+        threading.Thread(target=self.slack.serve_forever, name="Slack Stub", daemon=True).start()
+        self.calendar_service = FakeCalendarService(args.calendars, args.events)
+        os.chdir(WORK_DIR)
+        self.doorbell = BenchmarkDoorbell(
+            metrics.TimedWebClient(token=BOT_TOKEN, base_url=self.slack.url),
+            GoogleCalendar(self.calendar_service),  # type: ignore
+            SilentTTS(),
+        )
+        self.doorbell.directory.warm()
+        self.doorbell.wait_until_ready()
+        self.random = random.Random(0)
+        self.results: list[Result] = []
+        self.reminders = Result("EventPoller reminder delivery")  # Filled in by subscriptions()
+
+    def run(self) -> list[Result]:
+        """Runs every workload."""
+        self.measure("message_event", self.messages)
+        self.measure("mention_event subscribe", self.subscriptions)
+        self.results.append(self.reminders)
+        self.measure("mention_event door", self.rings)
+        return self.results
+
+    def close(self) -> None:
+        """Closes Doorbell and the Slack stub."""
+        self.doorbell.close()
+        self.slack.shutdown()
+
+    def measure(self, name: str, workload: Callable[[Result], None]) -> None:
+        """Runs a workload, counting the API calls and disk IO from the start of it until Doorbell is idle again."""
+        result = Result(name)
+        slack_calls, calendar_calls = self.slack.calls.copy(), self.calendar_service.calls.copy()
+        disk = _disk_io()
+        workload(result)
+        self._wait_until_idle()
+        database.flush()
+        result.slack_calls = self.slack.calls - slack_calls
+        result.calendar_calls = self.calendar_service.calls - calendar_calls
+        after = _disk_io()
+        if disk is not None and after is not None:
+            result.disk = (after[0] - disk[0], after[1] - disk[1])
+        self.results.append(result)
+
+    def messages(self, result: Result) -> None:
+        """Sends messages at a fixed rate, some of which mention roles."""
+        users = [user["id"] for user in self.slack.users]
+        roles = [f"role{i}" for i in range(self.args.roles)]
+        database.add_roles(roles)
+        for user in users:
+            database.set_user_roles(user, self.random.sample(roles, min(3, len(roles))))
+        start = perf_counter()
+        for i in range(self.args.messages):
+            text = "Has anyone seen the drill press key?"
+            if self.random.random() < self.args.mention_ratio:
+                text = f"@{self.random.choice(roles)} {text}"
+            body = {"event": {"channel": "C000000", "user": self.random.choice(users), "text": text, "ts": f"{i}.0"}}
+            _sleep_until(start + i / self.args.rate)
+            result.latencies.append(_time(self.doorbell.message_event, body))
+
+    def subscriptions(self, result: Result) -> None:
+        """Subscribes channels to calendars with reminders that are already due, so that the EventPoller
+        sends one reminder for each of them. How long each reminder takes to reach Slack goes in self.reminders."""
+        subscribed_at: dict[tuple[str, str], float] = {}
+        for i in range(self.args.subscriptions):
+            channel = self.slack.channels[i // self.args.calendars % len(self.slack.channels)]["id"]
+            calendar = f"Calendar {i % self.args.calendars}"
+            subscribed_at[(channel, calendar)] = monotonic()
+            body = {"event": {"channel": channel, "user": "U000000", "text": f"<@U0> subscribe 1 {calendar}"}}
+            say = Say(self.doorbell.client, channel)
+            result.latencies.append(_time(self.doorbell.mention_event, body, say))
+        deadline = monotonic() + 30
+        while len(self.reminders.latencies) < len(subscribed_at) and monotonic() < deadline:
+            sleep(0.05)
+            with self.slack.lock:
+                sent = [
+                    (at - subscribed_at[(channel, text.split(" event ")[0].removeprefix("Reminder: "))])
+                    for at, channel, text in self.slack.messages
+                    if text.startswith("Reminder: ")
+                ]
+            self.reminders.latencies = [latency for latency in sent if latency >= 0]
+
+    def rings(self, result: Result) -> None:
+        """Rings the doorbell in bursts from different users."""
+        database.set_schedule([[database.DaySchedule(dt.time(0, 0), dt.time(23, 59, 59))]] * 7)
+        for i in range(self.args.rings):
+            if i and i % self.args.burst == 0:
+                sleep(0.1)
+            body = {"event": {"channel": "C000000", "user": f"U{i % self.args.users:06}", "text": "<@U0> door 12a"}}
+            say = Say(self.doorbell.client, "C000000")
+            result.latencies.append(_time(self.doorbell.mention_event, body, say))
+
+    def _wait_until_idle(self) -> None:
+        """Waits until nothing has been sent to Slack for a little while."""
+        calls = -1
+        while calls != self.slack.calls.total():
+            calls = self.slack.calls.total()
+            sleep(0.2)
+
+
+def _time(function: Callable[..., None], *args: Any) -> float:
+    start = perf_counter()
+    function(*args)
+    return perf_counter() - start
+
+
+def _sleep_until(time: float) -> None:
+    delay = time - perf_counter()
+    if delay > 0:
+        sleep(delay)
+
+
+def _disk_io() -> Optional[tuple[int, int]]:
+    """Returns how many bytes this process has read from and written to storage so far, if the OS says."""
+    try:
+        with open("/proc/self/io", encoding="utf-8") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+    except OSError:
+        return None
+    return int(counters["read_bytes"]), int(counters["write_bytes"])
+
+
+def main() -> None:
+    """Runs the benchmark, exiting with 1 if a p99 latency is over --max-p99-ms."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=1000, help="messages to send to message_event")
+    parser.add_argument("--rate", type=float, default=200, help="messages per second")
+    parser.add_argument("--mention-ratio", type=float, default=0.3, help="fraction of messages that mention a role")
+    parser.add_argument("--roles", type=int, default=20)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--channels", type=int, default=50)
+    parser.add_argument("--subscriptions", type=int, default=100)
+    parser.add_argument("--calendars", type=int, default=10)
+    parser.add_argument("--events", type=int, default=50, help="events per calendar")
+    parser.add_argument("--rings", type=int, default=100)
+    parser.add_argument("--burst", type=int, default=20, help="rings per burst")
+    parser.add_argument("--max-p99-ms", type=float, default=None, help="fail if any p99 latency is higher")
+    parser.add_argument("--verbose", action="store_true", help="show Doorbell's output")
+    args = parser.parse_args()
+
+    output = sys.stdout if args.verbose else io.StringIO()
+    with redirect_stdout(output):
+        benchmark = Benchmark(args)
+        try:
+            results = benchmark.run()
+        finally:
+            benchmark.close()
+            shutil.rmtree(WORK_DIR, ignore_errors=True)
+    for result in results:
+        print(result)
+    if args.max_p99_ms is not None and any(result.percentile(99) > args.max_p99_ms for result in results):
+        print(f"p99 latency is over {args.max_p99_ms} ms.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""Tests that every command in Doorbell's dispatch table can be reached from a mention.
+Commands are swapped for ones that record what ran so that e.g. exit and update don't really run."""
+
+import argparse
+import shutil
+from dataclasses import replace
+from threading import Event
+
+import benchmark  # Stands in for Slack, Google and the secret module
+
+# pylint: disable=wrong-import-position,wrong-import-order
+from doorbell import Command, Doorbell, Invocation
+
+bench = benchmark.Benchmark(argparse.Namespace(users=1, channels=1, calendars=0, events=0))
+doorbell = bench.doorbell
+ran: list[str] = []
+done = Event()
+
+
+def recorder(name: str) -> Command:
+    """Returns a command that records its name and the word it was run with."""
+
+    def run(_: Doorbell, invocation: Invocation) -> None:
+        ran.append(f"{name} {invocation.args[0]}")
+        done.set()
+
+    return replace(Doorbell.COMMANDS[name], run=run)
+
+
+try:
+    doorbell.COMMANDS = {word: recorder(word) for word in Doorbell.COMMANDS}  # type: ignore[misc]
+    for word in [*Doorbell.COMMANDS, "bogus"]:
+        assert word == word.lower() and len(word.split()) == 1, f"{word!r} can't be matched by its first word"
+        done.clear()
+        doorbell.mention_event(
+            {"event": {"channel": "C000000", "user": "U000000", "text": f"<@U0> {word.upper()} 12a"}},
+            lambda *_, **__: None,  # type: ignore[arg-type]
+        )
+        assert done.wait(timeout=5), f"{word} never ran"
+    print(*ran, sep="\n")
+    door_words = [word for word, command in Doorbell.COMMANDS.items() if command.run is Doorbell.COMMANDS["door"].run]
+    assert sorted(door_words) == sorted(Doorbell.DOORBELL_WORDS)
+    assert ran == [f"{word} {word}" for word in Doorbell.COMMANDS] + ["help bogus"]
+finally:
+    bench.close()
+    shutil.rmtree(benchmark.WORK_DIR, ignore_errors=True)
@@ -2,6 +2,7 @@
 A command prefixed with # switches into that channel e.g. '#blueberry'."""
 
 import json
+import shutil
 import threading
 from random import randint
 from typing import override
@@ -21,10 +22,9 @@ class MockDoorbell(Doorbell):
         print(f"\n#{self.get_channel_name(channel_id)}> {message}")
 
     @override
-    def upload_file(self, channel_id: str, file: bytes, name: str) -> None:
+    def upload_file(self, channel_id: str, path: str, name: str) -> None:
         print(f"\n#{self.get_channel_name(channel_id)}> Uploading {name}.")
-        with open(name + "_upload_" + str(randint(1, 2**32)), "xb") as f:
-            f.write(file)
+        shutil.copyfile(path, name + "_upload_" + str(randint(1, 2**32)))
 
 
 def fake_response(text: str, channel_id: str) -> dict:
@@ -41,8 +41,8 @@ def main() -> None:
     """Runs the Doorbell CLI."""
     doorbell = MockDoorbell()
     print("Started Doorbell!")
-    print(json.dumps(doorbell.app.client.auth_test().data, indent=4))
-    channels = doorbell.app.client.conversations_list()["channels"]
+    print(json.dumps(doorbell.client.auth_test().data, indent=4))
+    channels = doorbell.client.conversations_list()["channels"]
     try:
         channel = "C05U4CM8B8X"  # bot-spam
         while not doorbell.closed:
@@ -55,7 +55,7 @@ def main() -> None:
                         print(f"Switched to channel {channel_name}")
                 continue
             if cmd.startswith("$"):
-                doorbell.message_event(fake_response(cmd, channel), doorbell.app.client)
+                doorbell.message_event(fake_response(cmd, channel))
             else:
                 doorbell.mention_event(fake_response("@Doorbell " + cmd, channel), print_ignore_kwargs)  # type: ignore
     except KeyboardInterrupt:
@@ -0,0 +1,73 @@
+"""Tests that the database journal replays changes that weren't written before a crash, is only compacted
+once a backup has its entries, and that a corrupted database is rebuilt from the latest backup and the journal.
+Runs in a temporary directory."""
+
+import glob
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+from time import sleep
+
+import backup
+import database
+
+ROLES = 300
+
+
+def crash() -> None:
+    """Writes some roles, queues more and dies before the flusher writes them."""
+    database.create()
+    database.add_roles(["a", "b"])
+    database.flush()
+    database.add_roles(["c"])
+    database.set_user_roles("user", {"a", "c"})
+    os._exit(1)
+
+
+def journal_lines() -> int:
+    """Returns how many entries are in the journal."""
+    with open(database.JOURNAL_PATH, "r", encoding="utf-8") as journal:
+        return len(journal.readlines())
+
+
+def wait_for_flusher() -> None:
+    """Waits for the flusher to write and compact what's been queued."""
+    sleep(database.FLUSH_DELAY_SECONDS * 3)
+
+
+if len(sys.argv) > 1:
+    crash()
+
+os.chdir(tempfile.mkdtemp())
+subprocess.run(
+    [sys.executable, os.path.abspath(__file__), "crash"],
+    env={**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)},
+    check=False,
+)
+database.create()
+data = database.read()
+print("Replayed:", sorted(data.roles), data.user_roles)
+assert data.roles == {"a", "b", "c"} and data.user_roles == {"user": {"a", "c"}}
+
+for i in range(ROLES):
+    database.add_roles([f"role {i}"])
+wait_for_flusher()
+print("Journal entries without a backup:", journal_lines())
+assert journal_lines() > ROLES  # Nothing is dropped until there's a backup
+
+backup.take()
+database.add_roles(["after backup"])
+wait_for_flusher()
+print("Journal entries after a backup:", journal_lines())
+assert journal_lines() == 1
+
+database.close()
+sqlite3.connect(database.FILE_PATH).execute("PRAGMA wal_checkpoint(TRUNCATE)")  # Or the WAL hides the corruption
+with open(database.FILE_PATH, "r+b") as f:
+    f.write(b"corrupted" * 1000)
+database.check_for_corruption(restore=backup.restore)
+data = database.read()
+print("Recovered roles:", len(data.roles))
+assert glob.glob(database.FILE_PATH + ".*.corrupted") and len(data.roles) == ROLES + 4
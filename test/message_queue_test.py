@@ -0,0 +1,35 @@
+"""Tests that closing a MessageQueue that's full, e.g. while Slack is rate limiting, still stops its workers."""
+
+from threading import Event, Timer
+from time import monotonic, sleep
+
+from message_queue import MessageQueue
+
+
+class SlowClient:
+    """Stands in for WebClient, posting blocks until release is set like a rate limited call."""
+
+    def __init__(self) -> None:
+        self.release = Event()
+        self.posted = 0
+
+    def chat_postMessage(self, **_: object) -> None:  # pylint: disable=invalid-name
+        """Waits until released, then counts the message as posted."""
+        self.release.wait()
+        self.posted += 1
+
+
+MessageQueue.CLOSE_TIMEOUT_SECONDS = 0.5  # type: ignore[misc]
+client = SlowClient()
+queue = MessageQueue(client, workers=2, max_size=5)  # type: ignore[arg-type]
+for i in range(7):  # Both workers get stuck on a message and the rest fill the queue
+    queue.post_message("C0", f"Message {i}")
+    sleep(0.1)
+Timer(1.0, client.release.set).start()
+start = monotonic()
+queue.close()
+for worker in queue._workers:  # pylint: disable=protected-access
+    worker.join(timeout=5)
+alive = [worker.name for worker in queue._workers if worker.is_alive()]  # pylint: disable=protected-access
+print(f"Closed in {monotonic() - start:.1f} seconds, posted {client.posted}, still running: {alive}")
+assert not alive and client.posted == 2  # The queued messages were dropped
@@ -1,11 +1,17 @@
-"""Tests the Text to Speech for Windows."""
+"""Tests the Text to Speech backend for this platform."""
 
 from time import sleep
 
-from tts import TTS
+from pygame import mixer
 
-tts = TTS()
+from tts import create_tts
+
+mixer.init()
+tts = create_tts()
 tts.say("Hello World hi hi hi lol", blocking=True)
+print(f"Time to first audio: {tts.time_to_first_audio:.3f}s")
 tts.say("Hello World")
 sleep(0.5)
 tts.say("Bob says hi", blocking=True)
+tts.stream("Streaming starts talking before the whole sentence has been synthesized.")
+print(f"Time to first audio (streaming): {tts.time_to_first_audio:.3f}s")